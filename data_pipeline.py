@@ -6,20 +6,198 @@
 
 import asyncio
 import aiohttp
+import contextlib
+import csv
 import datetime
-import glob
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from dataclasses import dataclass
+import functools
+import io
 import itertools
 import logging
+import os
+import pickle
+import random
 import requests
+import socket
+import threading
+import time
+import warnings
 from pathlib import Path
+from requests.adapters import HTTPAdapter
+from urllib3.util import Retry
 
+import numpy as np
 import obspy
+from obspy.io.mseed.core import _read_mseed
+from obspy.io.mseed.util import get_record_information
+
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+
+__all__ = ['RequestSpec', 'as_request_spec', 'save_request_params',
+           'load_request_params', 'iterate_chunks', 'list_files',
+           'iter_urls', 'make_urls', 'make_session', 'get_data',
+           'get_data_from_params', 'make_async_request', 'run',
+           'make_requests_session', 'form_request', 'chunked_data_query',
+           'threaded_data_query', 'make_request', 'gather_chunks',
+           'concatenate_chunk_files', 'merge_chunk_files',
+           'DEFAULT_CHUNKSIZE']
 
 log = logging.getLogger(__name__)
 
+# Default length of data to get in each request. Each request has a fixed
+# overhead, so fewer, larger requests are faster than many small ones.
+DEFAULT_CHUNKSIZE = datetime.timedelta(hours=6)
+
+# Number of chunks to make timestamps for at once (see
+# _iterate_chunk_stamps)
+_STAMP_BLOCKSIZE = 4096
+
+# HTTP statuses that are worth retrying a request for
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+# Connections kept open to each sensor by the synchronous functions
+POOL_MAXSIZE = 16
+# Chunks the sensor had no data for are marked with an empty file with
+# this suffix, and are not requested again until the mark is EMPTY_TTL old
+EMPTY_SUFFIX = '.empty'
+EMPTY_TTL = datetime.timedelta(days=7)
+# Marks made less than this long after the end of their chunk are ignored,
+# as the sensor may just not have had the data yet
+EMPTY_SETTLE = datetime.timedelta(hours=1)
+
+# Size (in bytes) of chunks to stream responses to disk in
+STREAM_CHUNKSIZE = 64 * 1024
+# Largest response (in bytes) to read into memory before writing to disk
+# in one go. Larger responses are streamed to disk in chunks, so memory
+# use is bounded however many requests are being made at once.
+MAX_BUFFER_SIZE = 8 * 1024 * 1024
+# Streamed chunks are gathered into batches of (at least) this many bytes
+# before being written, so large responses take fewer write syscalls
+# and thread hand-offs
+WRITE_BATCHSIZE = 1024 * 1024
+# Log progress once every this many requests to each sensor (requests
+# themselves are only logged at debug level)
+PROGRESS_INTERVAL = 100
+
 # Utility functions
 
 
+@dataclass(frozen=True, slots=True)
+class RequestSpec:
+    '''
+    Parameters of one data request. Start and end times are checked
+    when the RequestSpec is made.
+
+    Parameters:
+    ----------
+    network : str
+        Network code
+    station : str
+        Station code
+    location : str
+        Location code
+    channel : str
+        Channel code
+    start : obspy.UTCDateTime
+        Start time of request
+    end : obspy.UTCDateTime
+        End time of request
+    '''
+    network: str
+    station: str
+    location: str
+    channel: str
+    start: obspy.UTCDateTime
+    end: obspy.UTCDateTime
+
+    def __post_init__(self):
+        if not isinstance(self.start,
+                          obspy.UTCDateTime
+                          ) or not isinstance(self.end, obspy.UTCDateTime):
+            raise TypeError("Start and end times must be of type UTCDateTime.")
+        if self.start > self.end:
+            raise ValueError('Start after End!')
+
+
+def as_request_spec(params):
+    '''
+    Converts a tuple of request parameters
+    (net, stat, loc, channel, start, end) to a RequestSpec.
+    RequestSpecs are returned as is.
+    '''
+    if isinstance(params, RequestSpec):
+        return params
+    if len(params) != 6:
+        log.error(f'Malformed params {params}')
+        raise ValueError('Too few parameters in params')
+    return RequestSpec(*params)
+
+
+def save_request_params(path, request_params):
+    '''
+    Saves request parameters (e.g., a list of gaps to fill) to a NumPy
+    .npz file, which can be read back with load_request_params.
+    Seed codes are stored as string arrays and start/end times as
+    integer nanoseconds, so the file is small, quick to read and (unlike
+    a pickle) safe to load. The file is compressed, as seed codes
+    repeat a lot.
+
+    Parameters:
+    ----------
+    path : str or pathlib.Path
+        File to write to. numpy adds a .npz suffix if it is missing.
+    request_params : list
+        List of RequestSpecs, or of tuples
+        (net, stat, loc, channel, start, end)
+    '''
+    specs = [as_request_spec(params) for params in request_params]
+    columns = {key: np.array([getattr(spec, key) for spec in specs],
+                             dtype=str)
+               for key in ('network', 'station', 'location', 'channel')}
+    columns['start'] = np.array([spec.start.ns for spec in specs],
+                                dtype=np.int64)
+    columns['end'] = np.array([spec.end.ns for spec in specs],
+                              dtype=np.int64)
+    np.savez_compressed(path, **columns)
+
+
+def load_request_params(path):
+    '''
+    Reads request parameters saved by save_request_params.
+
+    Pickled lists of (net, stat, loc, channel, start, end) tuples
+    (files ending .pkl) can still be read, but this is deprecated as
+    loading a pickle can run arbitrary code.
+
+    Parameters:
+    ----------
+    path : str or pathlib.Path
+        File to read
+
+    Returns:
+    ----------
+    request_params : list
+        List of RequestSpecs
+    '''
+    if Path(path).suffix == '.pkl':
+        warnings.warn('Reading pickled request parameters is deprecated. ' +
+                      'Use save_request_params to make a .npz file',
+                      DeprecationWarning, stacklevel=2)
+        with open(path, 'rb') as f:
+            return [as_request_spec(params) for params in pickle.load(f)]
+    with np.load(path) as data:
+        columns = [data[key].tolist() for key in ('network', 'station',
+                                                  'location', 'channel',
+                                                  'start', 'end')]
+    return [RequestSpec(net, sta, loc, cha,
+                        obspy.UTCDateTime(ns=start),
+                        obspy.UTCDateTime(ns=end))
+            for net, sta, loc, cha, start, end in zip(*columns)]
+
+
 def iterate_chunks(start, end, chunksize):
     '''
     Function that makes an interator between two dates (start, end)
@@ -34,22 +212,93 @@ def iterate_chunks(start, end, chunksize):
     chunksize : datetime.timedelta
         timespan of chunks to split timespan into and iterate over
     '''
-    chunk_start = start
-    while chunk_start < end:
-        yield chunk_start
-        chunk_start += chunksize
+    for chunk_ns in _iterate_chunks_ns(start, end, chunksize):
+        yield obspy.UTCDateTime(ns=chunk_ns)
 
 
-def make_urls(ip_dict,
+def _iterate_chunks_ns(start, end, chunksize):
+    '''
+    As iterate_chunks, but yields the start of each chunk as an integer
+    number of nanoseconds since the UNIX epoch. Stepping through integers
+    is much cheaper than adding timedeltas to UTCDateTime objects.
+    '''
+    step_ns = _to_ns(chunksize)
+    chunk_ns = start.ns
+    end_ns = end.ns
+    while chunk_ns < end_ns:
+        yield chunk_ns
+        chunk_ns += step_ns
+
+
+def _iterate_chunk_stamps(start, end, chunksize):
+    '''
+    As _iterate_chunks_ns, but yields (chunk_ns, timestamp) where timestamp
+    is the start of the chunk formatted as YYYYmmddTHHMMSS. Timestamps are
+    made with numpy for a block of chunks at a time, which is much faster
+    than formatting a datetime for each chunk.
+    '''
+    step_ns = _to_ns(chunksize)
+    block_ns = step_ns * _STAMP_BLOCKSIZE
+    end_ns = end.ns
+    for block_start in range(start.ns, end_ns, block_ns):
+        chunks = np.arange(block_start, min(block_start + block_ns, end_ns),
+                           step_ns, dtype=np.int64)
+        stamps = np.datetime_as_string(chunks.astype('datetime64[ns]'),
+                                       unit='s')
+        # YYYY-mm-ddTHH:MM:SS -> YYYYmmddTHHMMSS
+        stamps = np.char.replace(np.char.replace(stamps, '-', ''), ':', '')
+        yield from zip(chunks.tolist(), stamps.tolist())
+
+
+def _to_ns(timespan):
+    '''
+    Converts a datetime.timedelta to an integer number of nanoseconds
+    '''
+    return (timespan // datetime.timedelta(microseconds=1)) * 1000
+
+
+def list_files(ddir):
+    '''
+    Returns the set of filenames in a directory. Uses one os.scandir
+    call, which is much cheaper than checking if each file exists in turn
+    (especially on network filesystems).
+
+    Parameters:
+    ----------
+    ddir : str or pathlib.Path
+        Directory to list. If it does not exist an empty set is returned.
+    '''
+    try:
+        with os.scandir(ddir) as entries:
+            return {entry.name for entry in entries if entry.is_file()}
+    except FileNotFoundError:
+        return set()
+
+
+def _ensure_dir(ddir, made_dirs):
+    '''
+    Makes ddir (and any parents) if it isn't in made_dirs, the set of
+    directories already made. The same day directories are used for every
+    station and channel, so this saves a mkdir syscall for each of them.
+    '''
+    if ddir not in made_dirs:
+        ddir.mkdir(exist_ok=True, parents=True)
+        made_dirs.add(ddir)
+
+
+def iter_urls(ip_dict,
               request_params,
               data_dir='',
-              chunksize=datetime.timedelta(hours=1),
-              buffer=datetime.timedelta(seconds=150)):
+              chunksize=DEFAULT_CHUNKSIZE,
+              buffer=datetime.timedelta(seconds=150),
+              made_dirs=None,
+              empty_ttl=EMPTY_TTL):
     '''
-    Makes urls for chunked requests.
-    Suitable for larger (or regular) data downloads
+    Generator which yields (url, outfile) for each chunked request
+    that has not already been downloaded. Urls are made as they are
+    needed, so we never hold every request in memory at once.
 
-    Default chunk size is 1 hour
+    Default chunk size is 6 hours
 
     Parameters:
     ----------
@@ -57,68 +306,189 @@ def make_urls(ip_dict,
         Dictionary of IP addresses of sensors.
         Includes port number if any port forwarding needed
     request_params : list
-        List of tuples (net, stat, loc, channel, start, end)
+        List of RequestSpecs, or of tuples
+        (net, stat, loc, channel, start, end)
     data_dir : str,
         Directory to write data to
     chunksize : datetime.timedelta
         Size of chunked request
+    made_dirs : set, optional
+        Directories already made. Pass the same set to several calls
+        (e.g. one for each sensor) to only make each day directory once.
+        Directories made by this call are added to it.
+    empty_ttl : datetime.timedelta
+        How long to skip chunks the sensor had no data for
+        (see EMPTY_TTL and EMPTY_SETTLE)
     '''
 #   If data dir is empty then use current directory
     if data_dir == '':
         data_dir = Path.cwd()
-    urls = []
-    outfiles = []
+    if made_dirs is None:
+        made_dirs = set()
+    # Cache of day directories and the existing files in them (both keyed
+    # by date)
+    day_dirs = {}
+    existing_files = {}
+    n_skipped = 0
+    buffer_ns = _to_ns(buffer)
+    chunksize_ns = _to_ns(chunksize)
+    chunk_tag = _chunk_tag(chunksize)
 
     for params in request_params:
-        if len(params) != 6:
-            log.error(f'Malformed params {params}')
-            raise ValueError('Too few parameters in params')
-        network = params[0]
-        station = params[1]
-        location = params[2]
-        channel = params[3]
-        start = params[4]
-        end = params[5]
-        sensor_ip = ip_dict[station]
-        if start > end:
-            raise ValueError('Start after End!')
-        if not isinstance(start,
-                          obspy.UTCDateTime
-                          ) or not isinstance(end, obspy.UTCDateTime):
-            raise TypeError("Start and end times must be of type UTCDateTime.")
-
-        for chunk_start in iterate_chunks(params[4], params[5], chunksize):
-            # Add 150 seconds buffer on either side
-            query_start = chunk_start - buffer
-            query_end = chunk_start + chunksize + buffer
-            year = chunk_start.year
-            month = chunk_start.month
-            day = chunk_start.day
-            hour = chunk_start.hour
-            mins = chunk_start.minute
-            sec = chunk_start.second
-
-            ddir = Path(f'{data_dir}/{year}/{month:02d}/{day:02d}')
-            ddir.mkdir(exist_ok=True, parents=True)
-            seed_params = f'{network}.{station}.{location}.{channel}'
-            date = f'{year}{month:02d}{day:02d}'
-            time = f'{hour:02d}{mins:02d}{sec:02d}'
-            timestamp = f'{date}T{time}'
-            outfile = ddir / f"{seed_params}.{timestamp}.mseed"
-            if outfile.is_file():
-                log.info(f'Data chunk {outfile} exists')
+        params = as_request_spec(params)
+        sensor_ip = ip_dict[params.station]
+        seed_params = (f'{params.network}.{params.station}.' +
+                       f'{params.location}.{params.channel}')
+        url_template = _url_template(sensor_ip, seed_params)
+        for chunk_ns, timestamp in _iterate_chunk_stamps(params.start,
+                                                         params.end,
+                                                         chunksize):
+            date = timestamp[:8]
+            ddir = day_dirs.get(date)
+            if ddir is None:
+                ddir = Path(data_dir, date[:4], date[4:6], date[6:])
+                day_dirs[date] = ddir
+                existing_files[date] = list_files(ddir)
+            existing = existing_files[date]
+            # Check the file name before making a Path, as most chunks
+            # already exist when re-running over a time period.
+            filename = f"{seed_params}.{timestamp}{chunk_tag}.mseed"
+            if filename in existing:
+                log.debug('Data chunk %s exists', filename)
+                n_skipped += 1
                 continue
-            else:
-                request_url = form_request(sensor_ip,
-                                           network,
-                                           station,
-                                           location,
-                                           channel,
-                                           query_start,
-                                           query_end
-                                           )
-                urls.append(request_url)
-                outfiles.append(outfile)
+            outfile = ddir / filename
+            if filename + EMPTY_SUFFIX in existing:
+                chunk_end = (chunk_ns + chunksize_ns) / 1e9
+                if _recently_empty(outfile, chunk_end, empty_ttl):
+                    log.debug('Data chunk %s was recently empty', outfile)
+                    n_skipped += 1
+                    continue
+                # The mark is out of date, so get rid of it and try again.
+                # If the chunk is still empty it is marked again.
+                _empty_mark(outfile).unlink(missing_ok=True)
+            # Only make directories we are going to write to, so
+            # re-runs over complete days don't make any syscalls
+            # beyond listing the directory.
+            _ensure_dir(ddir, made_dirs)
+            # Add buffer on either side. Done in integer nanoseconds
+            # as this is much cheaper than UTCDateTime arithmetic.
+            query_start = (chunk_ns - buffer_ns) / 1e9
+            query_end = (chunk_ns + chunksize_ns + buffer_ns) / 1e9
+            request_url = url_template % (query_start, query_end)
+            # Don't request the same chunk twice if request_params
+            # overlap (e.g., when filling gaps)
+            existing.add(filename)
+            yield request_url, outfile
+
+    if n_skipped > 0:
+        log.info('Skipped %d chunks that exist or were empty', n_skipped)
+
+
+def _check_chunksize(chunksize):
+    '''
+    Raises ValueError if chunksize isn't a positive whole number of
+    seconds, as chunk file names (see _chunk_tag) can't describe it
+    '''
+    if chunksize <= datetime.timedelta(0) or chunksize.microseconds != 0:
+        raise ValueError('chunksize must be a positive whole number of ' +
+                         f'seconds, not {chunksize}')
+
+
+def _chunk_tag(chunksize):
+    '''
+    Returns the part of chunk file names that gives the chunk size
+    (e.g. ".6h"), so chunks of different sizes that start at the same
+    time don't share a name. Hourly chunks have no tag, so they keep
+    the names they had before other chunk sizes were tagged.
+    '''
+    _check_chunksize(chunksize)
+    seconds = int(chunksize.total_seconds())
+    if seconds == 3600:
+        return ''
+    for unit, unit_seconds in (('d', 86400), ('h', 3600), ('m', 60)):
+        if seconds % unit_seconds == 0:
+            return f'.{seconds // unit_seconds}{unit}'
+    return f'.{seconds}s'
+
+
+def _empty_mark(outfile):
+    '''
+    Returns the path of the file marking outfile as empty
+    '''
+    outfile = Path(outfile)
+    return outfile.with_name(outfile.name + EMPTY_SUFFIX)
+
+
+def _mark_empty(outfile):
+    '''
+    Marks outfile as a chunk the sensor has no data for, so that it
+    is not requested again for a while (see EMPTY_TTL)
+    '''
+    try:
+        _empty_mark(outfile).touch()
+    except OSError as e:
+        # e.g. the day directory was removed. Marks only save requests,
+        # so this is not worth failing the request (or its task group) for.
+        log.warning('Could not mark %s as empty: %s', outfile, e)
+
+
+def _recently_empty(outfile, chunk_end, empty_ttl=EMPTY_TTL):
+    '''
+    Returns True if outfile was marked empty less than empty_ttl ago.
+    Marks made less than EMPTY_SETTLE after chunk_end (the UNIX time
+    the chunk ends at) don't count.
+    '''
+    try:
+        marked = _empty_mark(outfile).stat().st_mtime
+    except FileNotFoundError:
+        return False
+    if marked < chunk_end + EMPTY_SETTLE.total_seconds():
+        return False
+    return time.time() - marked < empty_ttl.total_seconds()
+
+
+def make_urls(ip_dict,
+              request_params,
+              data_dir='',
+              chunksize=DEFAULT_CHUNKSIZE,
+              buffer=datetime.timedelta(seconds=150),
+              empty_ttl=EMPTY_TTL):
+    '''
+    Makes urls for chunked requests.
+    Suitable for larger (or regular) data downloads
+
+    Default chunk size is 6 hours. See iter_urls to make urls lazily.
+
+    Parameters:
+    ----------
+    ip_dict : dict
+        Dictionary of IP addresses of sensors.
+        Includes port number if any port forwarding needed
+    request_params : list
+        List of RequestSpecs, or of tuples
+        (net, stat, loc, channel, start, end)
+    data_dir : str,
+        Directory to write data to
+    chunksize : datetime.timedelta
+        Size of chunked request
+    empty_ttl : datetime.timedelta
+        How long to skip chunks the sensor had no data for
+
+    Returns:
+    ----------
+    urls : list
+        Request urls
+    outfiles : list
+        Files to write each request to
+    '''
+    urls = []
+    outfiles = []
+    for request_url, outfile in iter_urls(ip_dict, request_params, data_dir,
+                                          chunksize, buffer,
+                                          empty_ttl=empty_ttl):
+        urls.append(request_url)
+        outfiles.append(outfile)
 
     return urls, outfiles
 
@@ -128,6 +498,69 @@ def make_urls(ip_dict,
 # requests.
 
 
+def run(coro, use_uvloop=True):
+    '''
+    Runs a coroutine (e.g., get_data(...)) to completion, like asyncio.run.
+
+    If uvloop is installed (pip install uvloop) it is used as the event
+    loop, which has less overhead per request than the default loop.
+
+    Parameters:
+    ----------
+    coro : coroutine
+        Coroutine to run
+    use_uvloop : bool
+        Use uvloop if it is installed. If False, always use asyncio's
+        default event loop.
+
+    Returns:
+    ----------
+    The result of coro
+    '''
+    if use_uvloop and uvloop is not None:
+        loop_factory = uvloop.new_event_loop
+    else:
+        loop_factory = None
+    with asyncio.Runner(loop_factory=loop_factory) as runner:
+        return runner.run(coro)
+
+
+def make_session(n_async_requests=3,
+                 keepalive_timeout=30,
+                 dns_cache_ttl=300,
+                 timeout=aiohttp.ClientTimeout(total=None,
+                                               sock_connect=30,
+                                               sock_read=300)):
+    '''
+    Makes an aiohttp ClientSession with a connection pool tuned
+    for many small requests to a handful of sensors.
+
+    Connections to each sensor are kept alive and re-used between
+    chunks, so we only pay the TCP handshake once per connection
+    rather than once per chunk. The number of simultaneous connections
+    to each sensor is capped by the connector (limit_per_host)
+    so we do not overload the Certimus.
+
+    Parameters:
+    ----------
+    n_async_requests : int
+        Max number of simultaneous requests to make to each sensor
+    keepalive_timeout : float
+        Time (in seconds) to keep idle connections open for re-use
+    dns_cache_ttl : int
+        Time (in seconds) to cache DNS lookups of sensor hostnames
+    timeout : aiohttp.ClientTimeout
+        Timeouts to apply to each request
+    '''
+    connector = aiohttp.TCPConnector(limit=0,
+                                     limit_per_host=n_async_requests,
+                                     keepalive_timeout=keepalive_timeout,
+                                     use_dns_cache=True,
+                                     ttl_dns_cache=dns_cache_ttl,
+                                     family=socket.AF_INET)
+    return aiohttp.ClientSession(connector=connector, timeout=timeout)
+
+
 async def get_data(networks,
                    stations,
                    locations,
@@ -136,51 +569,313 @@ async def get_data(networks,
                    end,
                    station_ips,
                    data_dir=Path.cwd(),
-                   chunksize=datetime.timedelta(hours=1),
+                   chunksize=DEFAULT_CHUNKSIZE,
                    buffer=datetime.timedelta(seconds=120),
-                   n_async_requests=3):
-
-    # Make all urls to query.
-    request_params = itertools.product(networks,
-                                       stations,
-                                       locations,
-                                       channels,
-                                       start,
-                                       end)
-
-    urls, outfiles = make_urls(station_ips,
-                               request_params,
-                               data_dir,
-                               chunksize,
-                               buffer)
-
-    log.info(f'There are {len(urls)} requests to make')
-    requests_by_ip = {}
-    for url, outfile in zip(urls, outfiles):
-        sensor_ip = url.split("/")[2]
-        if sensor_ip not in requests_by_ip:
-            requests_by_ip[sensor_ip] = []
-        requests_by_ip[sensor_ip].append((url, outfile))
-    # Set up asyncio's HTTP client session
-    semaphores = {sensor_ip: asyncio.Semaphore(n_async_requests)
-                  for sensor_ip in requests_by_ip}  # Adjust as needed
-    async with aiohttp.ClientSession() as session:
-        tasks = []
-        # Limit the number of simultaneous requests
-        # Adjust based on seismometer capacity
-        for sensor_ip, reqs in requests_by_ip.items():
-            semaphore = semaphores[sensor_ip]
-            for request_url, outfile in reqs:
-                task = asyncio.create_task(make_async_request(session,
-                                           semaphore,
-                                           request_url,
-                                           outfile)
-                                           )
-                tasks.append(task)
-        await asyncio.gather(*tasks)
-
-
-async def make_async_request(session, semaphore, request_url, outfile):
+                   n_async_requests=3,
+                   session=None,
+                   max_async_requests=None,
+                   empty_ttl=EMPTY_TTL):
+    '''
+    Asynchronously requests data for all combinations of the
+    given seed codes and time spans.
+
+    Parameters:
+    ----------
+    networks, stations, locations, channels : list
+        Seed codes to request data for
+    start, end : list
+        Lists of obspy.UTCDateTime start/end times of data to request
+    station_ips : dict
+        Dictionary of IP addresses of sensors.
+    data_dir : str
+        Directory to write data to
+    chunksize : datetime.timedelta
+        Size of chunked request
+    buffer : datetime.timedelta
+        Time buffer added to either side of each chunk
+    n_async_requests : int
+        Max number of simultaneous requests to make to each sensor
+    session : aiohttp.ClientSession, optional
+        Session to make requests with. Passing in a session lets
+        connections be re-used across calls to get_data. If None, a new
+        session is made (see make_session) and closed when done.
+        N.B. concurrency per sensor is set by the session's connector.
+    max_async_requests : int, optional
+        If given, the number of simultaneous requests to each sensor
+        adapts to how the sensor copes, between 1 and max_async_requests
+        (starting from n_async_requests). See get_data_from_params.
+    empty_ttl : datetime.timedelta
+        How long to skip chunks the sensor had no data for. Marks made
+        soon after the end of a chunk don't count (see EMPTY_SETTLE).
+    '''
+    # Group stations by sensor, then make each sensor's requests lazily
+    # so we never hold every combination of seed codes and times in memory.
+    sensor_stations = {}
+    for station in stations:
+        sensor_stations.setdefault(station_ips[station], []).append(station)
+    sensor_params = {
+        sensor_ip: (RequestSpec(*params) for params in
+                    itertools.product(networks,
+                                      sensor_stations[sensor_ip],
+                                      locations,
+                                      channels,
+                                      start,
+                                      end))
+        for sensor_ip in sensor_stations}
+    await _get_sensor_data(sensor_params,
+                           station_ips,
+                           data_dir,
+                           chunksize,
+                           buffer,
+                           n_async_requests,
+                           session,
+                           max_async_requests,
+                           empty_ttl)
+
+
+async def get_data_from_params(request_params,
+                               station_ips,
+                               data_dir=Path.cwd(),
+                               chunksize=DEFAULT_CHUNKSIZE,
+                               buffer=datetime.timedelta(seconds=120),
+                               n_async_requests=3,
+                               session=None,
+                               max_async_requests=None,
+                               empty_ttl=EMPTY_TTL):
+    '''
+    Asynchronously requests data for a list of request parameters.
+    Useful when the requests are not all combinations of some seed codes
+    and times (e.g., when filling in gaps).
+
+    Parameters:
+    ----------
+    request_params : list
+        List of RequestSpecs, or of tuples
+        (net, stat, loc, channel, start, end)
+    station_ips : dict
+        Dictionary of IP addresses of sensors.
+    data_dir : str
+        Directory to write data to
+    chunksize : datetime.timedelta
+        Size of chunked request
+    buffer : datetime.timedelta
+        Time buffer added to either side of each chunk
+    n_async_requests : int
+        Max number of simultaneous requests to make to each sensor
+    session : aiohttp.ClientSession, optional
+        Session to make requests with. If None, a new
+        session is made (see make_session) and closed when done.
+    max_async_requests : int, optional
+        If given, the number of simultaneous requests to each sensor
+        adapts to how the sensor copes, between 1 and max_async_requests
+        (starting from n_async_requests). It goes up while requests are
+        as fast as the fastest seen so far, and is halved whenever a
+        request attempt fails (and is retried). If a session is given its
+        connector must allow max_async_requests connections per host.
+    empty_ttl : datetime.timedelta
+        How long to skip chunks the sensor had no data for. Marks made
+        soon after the end of a chunk don't count (see EMPTY_SETTLE).
+    '''
+    # Split requests by sensor
+    sensor_params = {}
+    for params in request_params:
+        params = as_request_spec(params)
+        sensor_ip = station_ips[params.station]
+        sensor_params.setdefault(sensor_ip, []).append(params)
+    await _get_sensor_data(sensor_params,
+                           station_ips,
+                           data_dir,
+                           chunksize,
+                           buffer,
+                           n_async_requests,
+                           session,
+                           max_async_requests,
+                           empty_ttl)
+
+
+async def _get_sensor_data(sensor_params,
+                           station_ips,
+                           data_dir,
+                           chunksize,
+                           buffer,
+                           n_async_requests,
+                           session,
+                           max_async_requests,
+                           empty_ttl):
+    '''
+    Makes the requests for each sensor in sensor_params, a dictionary of
+    iterables of RequestSpecs keyed by sensor IP (see get_data_from_params
+    for the other parameters).
+
+    Each sensor gets its own pool of n_async_requests workers, so requests
+    to one sensor never wait behind a backlog of requests to another (the
+    connector only allows n_async_requests connections to each sensor).
+    '''
+    _check_chunksize(chunksize)
+
+    async def gather(session):
+        # Shared by every sensor, so each day directory is only made once
+        made_dirs = set()
+        async with asyncio.TaskGroup() as tg:
+            tasks = []
+            for sensor_ip, params in sensor_params.items():
+                reqs = iter_urls(station_ips, params, data_dir,
+                                 chunksize, buffer, made_dirs, empty_ttl)
+                tasks.append(tg.create_task(
+                    _gather_requests(session, reqs, n_async_requests,
+                                     max_async_requests, sensor_ip)))
+        return sum(task.result() for task in tasks)
+
+    if session is None:
+        async with make_session(max_async_requests
+                                or n_async_requests) as session:
+            n_requests = await gather(session)
+    else:
+        n_requests = await gather(session)
+    log.info('Made %d requests', n_requests)
+
+
+async def _gather_requests(session, reqs, n_workers, max_workers=None,
+                           sensor_ip=None):
+    '''
+    Makes a request for each (url, outfile) pair in reqs using
+    a fixed pool of workers fed by a bounded queue. This means we only hold
+    a few requests in memory at a time, rather than making a task for every
+    request up front. The number of simultaneous requests to each sensor
+    is limited by the session's connector.
+
+    If max_workers is given, max_workers workers are started but only
+    as many as an _AdaptiveLimit allows (starting from n_workers) make
+    requests at once.
+
+    Progress is logged every PROGRESS_INTERVAL requests (labelled
+    with sensor_ip).
+
+    Returns the number of requests made.
+    '''
+    if max_workers is None:
+        fetch = make_async_request
+    else:
+        limit = _AdaptiveLimit(n_workers, max_workers)
+        fetch = functools.partial(_limited_request, limit)
+        n_workers = max_workers
+    queue = asyncio.Queue(maxsize=2 * n_workers)
+    n_requests = 0
+    n_finished = 0
+
+    async def worker():
+        nonlocal n_finished
+        while True:
+            request = await queue.get()
+            if request is None:
+                return
+            request_url, outfile = request
+            await fetch(session, request_url, outfile)
+            n_finished += 1
+            if n_finished % PROGRESS_INTERVAL == 0:
+                log.info('Finished %d requests to %s', n_finished,
+                         sensor_ip)
+
+    async with asyncio.TaskGroup() as tg:
+        for _ in range(n_workers):
+            tg.create_task(worker())
+        # Making requests can list or make directories (see iter_urls), so
+        # take a few at a time in a thread rather than block the event loop
+        reqs = iter(reqs)
+        while batch := await asyncio.to_thread(
+                list, itertools.islice(reqs, n_workers)):
+            for request in batch:
+                await queue.put(request)
+                n_requests += 1
+        # Tell each worker there is nothing left to do
+        for _ in range(n_workers):
+            await queue.put(None)
+    return n_requests
+
+
+async def _limited_request(limit, session, request_url, outfile):
+    '''
+    Makes a request once limit (an _AdaptiveLimit) allows it, and tells
+    limit how long it took (or that it failed)
+    '''
+    await limit.acquire()
+    request_start = time.monotonic()
+    done = False
+    try:
+        done = await make_async_request(session, request_url, outfile,
+                                        on_error=limit.drop)
+    finally:
+        rtt = time.monotonic() - request_start
+        await limit.release(rtt if done else None)
+
+
+class _AdaptiveLimit:
+    '''
+    Additive increase / multiplicative decrease (AIMD) limit on the number
+    of requests made to one sensor at once.
+
+    The limit grows by 1/limit after each request that takes no more than
+    tolerance times the fastest request seen so far (i.e., by about one per
+    round of requests while the sensor keeps up), up to max_limit.
+    It is halved (down to 1) by drop, which is called whenever a request
+    attempt fails with an error worth retrying (e.g. the sensor is busy).
+
+    Parameters:
+    ----------
+    limit : int
+        Initial limit
+    max_limit : int
+        Largest the limit can grow to
+    tolerance : float
+        How much slower than the fastest request a request can be
+        and still count as the sensor keeping up
+    '''
+
+    def __init__(self, limit, max_limit, tolerance=2.0):
+        self.limit = float(min(limit, max_limit))
+        self.max_limit = max_limit
+        self.tolerance = tolerance
+        self.in_flight = 0
+        self.min_rtt = None
+        self._cond = asyncio.Condition()
+
+    async def acquire(self):
+        '''
+        Waits until another request can be made
+        '''
+        async with self._cond:
+            await self._cond.wait_for(
+                lambda: self.in_flight < int(self.limit))
+            self.in_flight += 1
+
+    def drop(self):
+        '''
+        Records that a request attempt failed, halving the limit
+        '''
+        # Lowering the limit never lets a waiting request go, so there
+        # is no need to notify anyone
+        self.limit = max(1.0, self.limit / 2)
+
+    async def release(self, rtt=None):
+        '''
+        Records that a request has finished, taking rtt seconds.
+        rtt is None if the request failed (in which case the limit
+        has already been lowered by drop).
+        '''
+        async with self._cond:
+            self.in_flight -= 1
+            if rtt is not None:
+                if self.min_rtt is None or rtt < self.min_rtt:
+                    self.min_rtt = rtt
+                if rtt <= self.tolerance * self.min_rtt:
+                    self.limit = min(self.max_limit,
+                                     self.limit + 1 / self.limit)
+            self._cond.notify_all()
+
+
+async def make_async_request(session, request_url, outfile,
+                             max_retries=3, backoff=1, max_wait=30,
+                             on_error=None):
     '''
     Function to actually make the HTTP GET request from the Certimus
 
@@ -188,37 +883,303 @@ async def make_async_request(session, semaphore, request_url, outfile):
     it out as miniSEED
     to the specified outfile
 
+    Data is first written to a .part file, which is moved to outfile
+    once the download is complete. If a download fails part way through
+    the .part file is kept and the next request for the same outfile
+    asks the sensor for only the remaining bytes (using a Range header).
+    If the sensor does not support ranged requests the whole file is
+    downloaded again. If it can't send the remaining bytes (416), or
+    sends a different range (see its Content-Range header), the .part
+    file is deleted and the whole file requested again.
+
+    Requests that fail with a connection error, a timeout, an incomplete
+    response, or an HTTP status in RETRY_STATUSES are retried with
+    exponential backoff (plus some random jitter). If the sensor sends
+    a Retry-After header we wait for that long instead. Waits are capped
+    at max_wait, so one request can't hold up a worker for too long.
+
     Parameters:
     ----------
+    session : aiohttp.ClientSession
+        Session to make the request with
     request_url : str
         The formed request url in the form:
         http://{sensor_ip}/data?channel={net_code}.{stat_code}.{loc_code}.{channel}&from={startUNIX}&to={endUNIX}
+    outfile : str
+        Filename (including full path) to write out to
+    max_retries : int
+        Max number of times to retry a failed request
+    backoff : float
+        Time (in seconds) to wait before the first retry. This
+        doubles after each failed retry.
+    max_wait : float
+        Max time (in seconds) to wait before any retry
+    on_error : callable, optional
+        Called (with no arguments) each time an attempt fails with
+        an error worth retrying, e.g. to back off other requests to
+        the same sensor.
+
+    Returns:
+    ----------
+    done : bool
+        False if the request failed after retrying (or with an
+        unexpected error). True if it succeeded, or if the sensor
+        answered with an error that retrying would not fix (e.g. 404).
     '''
-    async with semaphore:
+    for attempt in range(max_retries + 1):
         try:
-            async with session.get(request_url) as resp:
-                print(f'Request at {datetime.datetime.now()}')
-                print(request_url)
-                # Raise HTTP error for 4xx/5xx errors
-                resp.raise_for_status()
-
-                # Read binary data from the response
-                data = await resp.read()
-                if len(data) == 0:
-                    log.error('Request is empty!' +
-                              'Won’t write a zero byte file.')
-                    return
-                # Now write data
-                with open(outfile, "wb") as f:
-                    f.write(data)
-                log.info(f'Successfully wrote data to {outfile}')
-
+            await _download(session, request_url, outfile)
+            return True
         except aiohttp.ClientResponseError as e:
-            log.error(f'Client error for {request_url}: {e}')
-            # Additional handling could go here, like retry logic
+            if e.status not in RETRY_STATUSES:
+                await _client_error(request_url, outfile, e)
+                return True
+            error = e
+        except (aiohttp.ClientConnectionError,
+                aiohttp.ClientPayloadError,
+                asyncio.TimeoutError) as e:
+            error = e
         except Exception as e:
-            log.error(f'Unexpected error for {request_url}: {e}')
+            log.error('Unexpected error for %s: %s', request_url, e)
+            return False
+        if on_error is not None:
+            on_error()
+        if attempt == max_retries:
+            break
+        wait = _retry_wait(error, attempt, backoff, max_wait)
+        log.warning('Request for %s failed (%s). Retrying in %.1f seconds',
+                    request_url, error, wait)
+        await asyncio.sleep(wait)
+
+    log.error('Request for %s failed after %d retries: %s',
+              request_url, max_retries, error)
+    return False
+
+
+async def _client_error(request_url, outfile, error):
+    '''
+    Logs an HTTP error that retrying would not fix. Chunks that
+    aren't found are marked as empty.
+    '''
+    log.error('Client error for %s: %s', request_url, error)
+    if error.status == 404:
+        await asyncio.to_thread(_mark_not_found, outfile)
+
+
+def _mark_not_found(outfile):
+    '''
+    Marks outfile as empty after the sensor answered 404, and deletes any
+    part file left by an earlier download, so it isn't resumed from once
+    the mark expires
+    '''
+    _mark_empty(outfile)
+    outfile = Path(outfile)
+    outfile.with_name(f'{outfile.name}.part').unlink(missing_ok=True)
+
+
+def _retry_wait(error, attempt, backoff, max_wait):
+    '''
+    Returns how long to wait (in seconds) before retrying after attempt
+    failed with error (see make_async_request)
+    '''
+    wait = None
+    if isinstance(error, aiohttp.ClientResponseError):
+        wait = _retry_after(error.headers)
+    if wait is None:
+        wait = backoff * 2**attempt + random.uniform(0, backoff)
+    return min(wait, max_wait)
+
+
+def _retry_after(headers):
+    '''
+    Returns the wait time (in seconds) from a Retry-After header,
+    or None if there isn't one (or it is an HTTP date).
+    '''
+    if headers is None:
+        return None
+    try:
+        return float(headers['Retry-After'])
+    except (KeyError, ValueError):
+        return None
+
+
+async def _download(session, request_url, outfile):
+    '''
+    Makes one attempt at downloading request_url to outfile
+    (see make_async_request). If the download can't be resumed from
+    its part file, the part file is deleted and the whole file is
+    requested again.
+    Raises aiohttp errors if the request fails.
+    '''
+    outfile = Path(outfile)
+    partfile = outfile.with_name(f'{outfile.name}.part')
+    try:
+        offset = partfile.stat().st_size
+    except FileNotFoundError:
+        offset = 0
+    async with session.get(request_url,
+                           headers=_resume_headers(offset)) as resp:
+        log.debug('Request: %s', request_url)
+        resumable = offset == 0 or _resumes_at(resp, offset)
+        if resumable:
+            await _save_response(resp, outfile, partfile)
+    if not resumable:
+        # The part file doesn't line up with the data the sensor has,
+        # so start again from scratch
+        log.warning('Could not resume download of %s. Starting again',
+                    outfile)
+        await asyncio.to_thread(partfile.unlink, missing_ok=True)
+        await _download(session, request_url, outfile)
+
+
+async def _save_response(resp, outfile, partfile):
+    '''
+    Writes the data in resp to partfile and moves it to outfile once
+    complete (see _download).
+    '''
+    # Raise HTTP error for 4xx/5xx errors
+    resp.raise_for_status()
+    # Sensor only sends the remaining bytes if it supports Range
+    resume = resp.status == 206
+    mode = "ab" if resume else "wb"
+    # aiohttp decompresses gzip/deflate responses as they are read, so
+    # Content-Length is only the size of the data if it is uncompressed
+    if resp.headers.get('Content-Encoding', 'identity') == 'identity':
+        content_length = resp.content_length
+    else:
+        content_length = None
+    # File writes are done in a thread so they don't block other requests
+    if content_length and content_length <= MAX_BUFFER_SIZE:
+        n_bytes = await _buffer_to_file(resp, partfile, mode,
+                                        content_length)
+    elif content_length == 0:
+        # No need to read the body at all
+        n_bytes = 0
+    else:
+        n_bytes = await _stream_to_file(resp, partfile, mode)
+    if n_bytes == 0 and not resume:
+        log.error('Request is empty! Won’t write a zero byte file.')
+        await asyncio.to_thread(_mark_empty, outfile)
         return
+    if content_length is not None and n_bytes != content_length:
+        raise aiohttp.ClientPayloadError(
+            f'Incomplete download. Got {n_bytes} of ' +
+            f'{content_length} bytes')
+    # Renames can also block on slow (e.g. network) filesystems
+    await asyncio.to_thread(partfile.replace, outfile)
+    log.debug('Successfully wrote data to %s', outfile)
+
+
+def _resumes_at(resp, offset):
+    '''
+    Returns False if resp, to a request for the rest of a download from
+    offset bytes, can't be added to the part file: i.e. the sensor can't
+    send that range (e.g. the part file is longer than the data now is),
+    or sent a different range to the one asked for.
+    '''
+    if resp.status == 416:
+        return False
+    if resp.status != 206:
+        # The whole file (which replaces the part file) or an error
+        return True
+    return _content_range_start(resp.headers) == offset
+
+
+def _content_range_start(headers):
+    '''
+    Returns the first byte position in a Content-Range header
+    (e.g. "bytes 100-199/200"), or None if there isn't a valid one
+    '''
+    unit, _, byte_range = headers.get('Content-Range', '').partition(' ')
+    if unit != 'bytes':
+        return None
+    try:
+        return int(byte_range.split('-', 1)[0])
+    except ValueError:
+        return None
+
+
+def _resume_headers(offset):
+    '''
+    Returns the headers to request the rest of a download, offset bytes
+    of which are already in its part file (None if offset is 0)
+    '''
+    if offset == 0:
+        return None
+    # Byte ranges of a compressed response wouldn't line up with the
+    # (decompressed) data already in the part file.
+    return {'Range': f'bytes={offset}-',
+            'Accept-Encoding': 'identity'}
+
+
+async def _buffer_to_file(resp, partfile, mode, content_length):
+    '''
+    Reads a response of content_length bytes into one buffer and writes
+    it out to partfile in one go. If the download fails part way through,
+    what we have is written out so it can be resumed.
+    Returns the number of bytes written.
+    '''
+    data = memoryview(bytearray(content_length))
+    n_bytes = 0
+    try:
+        async for chunk in resp.content.iter_any():
+            data[n_bytes:n_bytes + len(chunk)] = chunk
+            n_bytes += len(chunk)
+    finally:
+        if n_bytes > 0:
+            await asyncio.to_thread(_write_file, partfile, mode,
+                                    data[:n_bytes])
+    return n_bytes
+
+
+async def _stream_to_file(resp, partfile, mode):
+    '''
+    Streams a response to partfile in chunks, writing them out in batches
+    of WRITE_BATCHSIZE bytes. If the download fails part way through, what
+    we have is written out so it can be resumed. partfile isn't opened
+    if the response is empty.
+    Returns the number of bytes written.
+    '''
+    chunks = resp.content.iter_chunked(STREAM_CHUNKSIZE)
+    first_chunk = await anext(chunks, b'')
+    if len(first_chunk) == 0:
+        return 0
+    f = await asyncio.to_thread(open, partfile, mode,
+                                buffering=WRITE_BATCHSIZE)
+    batch = [first_chunk]
+    n_bytes = n_batched = len(first_chunk)
+    try:
+        async for chunk in chunks:
+            batch.append(chunk)
+            n_bytes += len(chunk)
+            n_batched += len(chunk)
+            if n_batched >= WRITE_BATCHSIZE:
+                await asyncio.to_thread(f.writelines, batch)
+                batch = []
+                n_batched = 0
+    finally:
+        # Write out what we have, so a failed download can be resumed
+        await asyncio.to_thread(_close_file, f, batch)
+    return n_bytes
+
+
+def _close_file(f, batch):
+    '''
+    Writes out a batch of chunks to file f and closes it
+    '''
+    try:
+        f.writelines(batch)
+    finally:
+        f.close()
+
+
+def _write_file(outfile, mode, data):
+    '''
+    Writes data to outfile, opened with the given mode
+    '''
+    # Unbuffered, as data is always written in one large block
+    with open(outfile, mode, buffering=0) as f:
+        f.write(data)
 
 
 # core synchronous functions
@@ -227,6 +1188,39 @@ async def make_async_request(session, semaphore, request_url, outfile):
 # these functions are still tested
 
 
+# Retry policy for the synchronous functions
+_RETRY = Retry(total=5, connect=3, read=3, backoff_factor=1.0,
+               status_forcelist=RETRY_STATUSES,
+               allowed_methods=frozenset(['GET']))
+
+
+def make_requests_session(pool_maxsize=POOL_MAXSIZE, pool_connections=16):
+    '''
+    Makes a requests Session for the synchronous functions. Connections
+    to each sensor are kept alive and re-used between requests, and
+    requests that fail to connect, fail part way or get a retryable
+    status (see RETRY_STATUSES) are retried with exponential backoff.
+
+    Parameters:
+    ----------
+    pool_maxsize : int
+        Max number of connections to keep open to each sensor. Should be
+        at least the number of threads making requests to each sensor.
+    pool_connections : int
+        Max number of sensors to keep connections open to.
+    '''
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_connections,
+                          pool_maxsize=pool_maxsize,
+                          max_retries=_RETRY)
+    session.mount('http://', adapter)
+    return session
+
+
+# Session used by the synchronous functions when one isn't given.
+_session = make_requests_session()
+
+
 def form_request(sensor_ip,
                  network,
                  station,
@@ -259,12 +1253,20 @@ def form_request(sensor_ip,
         raise ValueError('Start of request if before the end!')
 
     seed_params = f'{network}.{station}.{location}.{channel}'
-    timeselect = f'from={starttime.timestamp}&to={endtime.timestamp}'
-    request = f'http://{sensor_ip}/data?channel={seed_params}&{timeselect}'
+    request = _url_template(sensor_ip, seed_params) % (starttime.timestamp,
+                                                       endtime.timestamp)
 
     return request
 
 
+def _url_template(sensor_ip, seed_params):
+    '''
+    Makes a template for request urls to one channel of a sensor,
+    which is %-formatted with the start and end (UNIX) times of a request.
+    '''
+    return f'http://{sensor_ip}/data?channel={seed_params}&from=%s&to=%s'
+
+
 def chunked_data_query(sensor_ip,
                        network,
                        station,
@@ -273,12 +1275,15 @@ def chunked_data_query(sensor_ip,
                        starttime,
                        endtime,
                        data_dir='',
-                       chunksize=datetime.timedelta(hours=1),
-                       buffer=datetime.timedelta(seconds=150)):
+                       chunksize=DEFAULT_CHUNKSIZE,
+                       buffer=datetime.timedelta(seconds=150),
+                       n_threads=3,
+                       session=None):
     '''
     Make chunked requests. Suitable for larger (or regular) data downloads
 
-    Default chunk size is 1 hour
+    Default chunk size is 6 hours. Requests are made from a pool of
+    n_threads threads so that several chunks are downloaded at once.
 
     Parameters:
     ----------
@@ -300,46 +1305,155 @@ def chunked_data_query(sensor_ip,
         Directory to write data to
     chunksize : datetime.timedelta
         Size of chunked request
+    n_threads : int
+        Max number of simultaneous requests to make to the sensor
+    session : requests.Session, optional
+        Session to make requests with. If None, a module level
+        session is used, which keeps connections to sensors alive
+        between calls.
+
+    Returns:
+    ----------
+    failed : list
+        (request_url, outfile) of each request that failed after retrying
     '''
 #   If data dir is empty then use current directory
     if data_dir == '':
         data_dir = Path.cwd()
 
-    for chunk_start in iterate_chunks(starttime, endtime, chunksize):
-        # Add 150 seconds buffer on either side
-        query_start = chunk_start - buffer
-        query_end = chunk_start + chunksize + buffer
-        year = chunk_start.year
-        month = chunk_start.month
-        day = chunk_start.day
-        hour = chunk_start.hour
-        mins = chunk_start.minute
-        sec = chunk_start.second
-
-        ddir = Path(f'{data_dir}/{year}/{month:02d}/{day:02d}')
-        ddir.mkdir(exist_ok=True, parents=True)
-        seed_params = f'{network}.{station}.{location}.{channel}'
-        timestamp = f'{year}{month:02d}{day:02d}T{hour:02d}{mins:02d}{sec:02d}'
-        outfile = ddir / f"{seed_params}.{timestamp}.mseed"
-        if outfile.is_file():
-            log.info(f'Data chunk {outfile} exists')
-            continue
-        else:
-            request_url = form_request(sensor_ip, network, station, location,
-                                       channel, query_start, query_end)
-            try:
-                make_request(request_url, outfile)
-            except requests.exceptions.RequestException as e:
-                log.error(f'GET request failed with error {e}')
-                continue
-            except requests.exceptions.HTTPError as e:
-                log.error(f'GET request failed with HTTPError {e}')
-                continue
+    request_params = [(network, station, location, channel,
+                       starttime, endtime)]
+    return threaded_data_query(request_params, {station: sensor_ip},
+                               data_dir, chunksize, buffer, n_threads,
+                               session)
 
-    return
+
+def threaded_data_query(request_params,
+                        station_ips,
+                        data_dir='',
+                        chunksize=DEFAULT_CHUNKSIZE,
+                        buffer=datetime.timedelta(seconds=150),
+                        n_threads=3,
+                        session=None,
+                        empty_ttl=EMPTY_TTL):
+    '''
+    Make chunked requests for a list of request parameters, using threads.
+    A synchronous alternative to get_data_from_params.
+
+    Each sensor gets its own pool of n_threads threads, so requests to
+    different sensors are made at the same time without making too
+    many simultaneous requests to any one sensor. Requests are made
+    as they are needed, with at most 2 * n_threads waiting or in progress
+    for each sensor, so memory use doesn't grow with the time span.
+
+    Parameters:
+    ----------
+    request_params : list
+        List of RequestSpecs, or of tuples
+        (net, stat, loc, channel, start, end)
+    station_ips : dict
+        Dictionary of IP addresses of sensors.
+    data_dir : str,
+        Directory to write data to
+    chunksize : datetime.timedelta
+        Size of chunked request
+    buffer : datetime.timedelta
+        Time buffer added to either side of each chunk
+    n_threads : int
+        Max number of simultaneous requests to make to each sensor
+    session : requests.Session, optional
+        Session to make requests with. If None, the module
+        level session is used (or, if n_threads is larger than its
+        connection pool, a new session made with make_requests_session).
+    empty_ttl : datetime.timedelta
+        How long to skip chunks the sensor had no data for. Marks made
+        soon after the end of a chunk don't count (see EMPTY_SETTLE).
+
+    Returns:
+    ----------
+    failed : list
+        (request_url, outfile) of each request that failed after retrying,
+        so they can be re-made later with make_request.
+    '''
+    if data_dir == '':
+        data_dir = Path.cwd()
+    _check_chunksize(chunksize)
+
+    failed = []
+    with contextlib.ExitStack() as stack:
+        if session is None and n_threads > POOL_MAXSIZE:
+            # Module level session can't keep enough connections open
+            session = stack.enter_context(
+                make_requests_session(pool_maxsize=n_threads))
+        # Split requests by sensor. All the requests to one sensor go
+        # through one iter_urls, so chunks in overlapping params are only
+        # requested once.
+        sensor_params = {}
+        for params in request_params:
+            params = as_request_spec(params)
+            sensor_ip = station_ips[params.station]
+            sensor_params.setdefault(sensor_ip, []).append(params)
+        made_dirs = set()
+        executors = [stack.enter_context(
+                         ThreadPoolExecutor(max_workers=n_threads))
+                     for _ in sensor_params]
+        # Each sensor's requests are made (lazily) and handed to its pool
+        # by a feeder thread, so all sensors start at once. Feeders finish
+        # (when entered last) before the sensors' pools are shut down.
+        feeders = stack.enter_context(
+            ThreadPoolExecutor(max_workers=max(1, len(sensor_params))))
+        futures = [feeders.submit(_feed_sensor, executor,
+                                  iter_urls(station_ips, params, data_dir,
+                                            chunksize, buffer, made_dirs,
+                                            empty_ttl),
+                                  2 * n_threads, session, failed)
+                   for executor, params in zip(executors,
+                                               sensor_params.values())]
+        for future in futures:
+            future.result()
+    if failed:
+        log.warning('%d requests failed', len(failed))
+    return failed
+
+
+def _feed_sensor(executor, reqs, max_queued, session, failed):
+    '''
+    Submits a request to executor for each (request_url, outfile) in reqs
+    (see _query_chunk). At most max_queued requests are waiting or being
+    made at once, so we never hold a future for every request.
+    '''
+    slots = threading.BoundedSemaphore(max_queued)
+    for request_url, outfile in reqs:
+        slots.acquire()
+        future = executor.submit(_query_chunk, request_url, outfile,
+                                 session, failed)
+        future.add_done_callback(lambda _: slots.release())
+
+
+def _query_chunk(request_url, outfile, session=None, failed=None):
+    '''
+    Makes a request for one chunk, logging any failures (including
+    unexpected errors, such as failing to write the file).
+    Failed requests are appended to failed (if given) as
+    (request_url, outfile).
+    '''
+    try:
+        make_request(request_url, outfile, session)
+    except requests.exceptions.HTTPError as e:
+        log.error('GET request failed with HTTPError %s', e)
+    except requests.exceptions.RequestException as e:
+        log.error('GET request failed with error %s', e)
+    except Exception as e:
+        # e.g. an OSError writing the file. Anything raised here would
+        # otherwise be lost in the (discarded) future of the thread pool.
+        log.error('Unexpected error for %s: %s', request_url, e)
+    else:
+        return
+    if failed is not None:
+        failed.append((request_url, outfile))
 
 
-def make_request(request_url, outfile):
+def make_request(request_url, outfile, session=None):
     '''
     Function to actually make the HTTP GET request from the Certimus
 
@@ -354,22 +1468,50 @@ def make_request(request_url, outfile):
         http://{sensor_ip}/data?channel={net_code}.{stat_code}.{loc_code}.{channel}&from={startUNIX}&to={endUNIX}
     outfile : str
         Filename (including full path) to write out to
+    session : requests.Session, optional
+        Session to make the request with. If None, the module level
+        session is used.
     '''
-    log.info(f'Request: {request_url}')
-    print(request_url)
-    r = requests.get(request_url, stream=True)
-
-    log.info(f'Request elapsed time {r.elapsed}')
-    # Raise HTTP error for 4xx/5xx errors
-    if r.status_code != 200:
-        raise requests.exceptions.HTTPError
-    # Check if we get data
-    if len(r.content) == 0:
-        log.error('Request is empty! Won’t write a zero byte file.')
-        return
-    # Now write data
-    with open(outfile, "wb") as f:
-        f.write(r.content)
+    if session is None:
+        session = _session
+    log.debug('Request: %s', request_url)
+    with session.get(request_url, stream=True, timeout=(5, 60)) as r:
+        log.debug('Request elapsed time %s', r.elapsed)
+        # Raise HTTP error for 4xx/5xx errors
+        if r.status_code == 404:
+            # No data for this chunk. Retrying won't help, so mark it
+            # as empty rather than failing (as make_async_request does)
+            log.error('No data found for %s', request_url)
+            _mark_not_found(outfile)
+            return
+        if r.status_code != 200:
+            raise requests.exceptions.HTTPError
+        # Stream data to file in chunks, so we never hold
+        # the whole response in memory.
+        blocks = r.iter_content(chunk_size=STREAM_CHUNKSIZE)
+        first_block = next(blocks, b'')
+        # Check if we get data
+        if len(first_block) == 0:
+            log.error('Request is empty! Won’t write a zero byte file.')
+            _mark_empty(outfile)
+            return
+        # Now write data. Write to a .part file and only move it to
+        # outfile once complete, so a crash never leaves a partial chunk
+        # that later runs would skip as already downloaded.
+        outfile = Path(outfile)
+        partfile = outfile.with_name(f'{outfile.name}.part')
+        try:
+            # Blocks are large, so write them straight to the file
+            # rather than through Python's io buffer.
+            with open(partfile, "wb", buffering=0) as f:
+                f.write(first_block)
+                for block in blocks:
+                    f.write(block)
+        except BaseException:
+            # Don't leave partial files behind
+            partfile.unlink(missing_ok=True)
+            raise
+        partfile.replace(outfile)
 
     return
 
@@ -382,7 +1524,10 @@ def gather_chunks(network,
                   endtime,
                   data_dir,
                   gather_size=datetime.timedelta(days=1),
-                  file_format='MSEED'):
+                  file_format='MSEED',
+                  cleanup=True,
+                  n_processes=1,
+                  merge=True):
     '''
     Function to gather all chunks of data pulled from server
     and gather then into larger files
@@ -396,65 +1541,267 @@ def gather_chunks(network,
     gather_size : datetime.timedelta
         Time period of gathers. Default is one day
         (i.e, all data in a day will be gathered)
+    cleanup : bool
+        If True (default) delete the chunked files once they are gathered.
+        Set to False to keep them (e.g., to check the gathered files first)
+    n_processes : int
+        Number of processes to make gathers with. Default is 1 (gathers
+        are made one at a time in this process). Reading and merging
+        chunks is CPU bound, so using more processes speeds up gathering
+        long time periods on multi-core machines.
+    merge : bool
+        If True (default) chunks are decoded and merged into one trace
+        (see merge_chunk_files) before being written out.
+        If False the miniSEED records of the chunks are copied into the
+        gathered file as they are (see concatenate_chunk_files), which is
+        much faster but only supports file_format='MSEED'.
     '''
+    if not merge and file_format.upper() != 'MSEED':
+        raise ValueError('Chunks can only be concatenated into MSEED files')
     if data_dir == '':
         data_dir = Path.cwd()
 
-    for gather_start in iterate_chunks(starttime, endtime, gather_size):
-        year = gather_start.year
-        month = gather_start.month
-        day = gather_start.day
-        hour = gather_start.hour
-        mins = gather_start.minute
-        ddir = Path(f'{data_dir}/{year}/{month:02d}/{day:02d}')
-        seed_params = f'{network}.{station}.{location}.{channel}'
-        if gather_size.days == 1:
-            # Want to read all files in that day
-            timestamp = f'{year}{month:02d}{day:02d}T*'
-        elif gather_size.second == 3600:
-            # Hour gather
-            timestamp = f'{year}{month:02d}{day:02d}T{hour:02d}*'
-        elif gather_size.second == 60:
-            # Minute gather
-            timestamp = f"{year}{month:02d}{day:02d}T{hour:02d}{mins:02d}*"
-        else:
-            raise ValueError(f'Gather {gather_size} not day, hour, or minute.')
-        filestem = f"{seed_params}.{timestamp}.mseed"
-        try:
-            gathered_st = obspy.read(f'{ddir}/{filestem}')
-        except Exception:
-            log.error(f'No files matching {filestem}')
-            continue
+    seed_params = f'{network}.{station}.{location}.{channel}'
+    gathers = iterate_chunks(starttime, endtime, gather_size)
+    args = (seed_params, data_dir, gather_size, file_format, cleanup, merge)
+    if n_processes == 1:
+        for gather_start in gathers:
+            _gather(gather_start, *args)
+    else:
+        # Each gather reads and decodes its own chunk files, so
+        # gathers can be made in parallel
+        with ProcessPoolExecutor(max_workers=n_processes) as pool:
+            futures = [pool.submit(_gather, gather_start, *args)
+                       for gather_start in gathers]
+            for future in futures:
+                future.result()
+
+
+def _gather(gather_start, seed_params, data_dir, gather_size, file_format,
+            cleanup, merge):
+    '''
+    Gathers the chunks for one gather (see gather_chunks)
+    '''
+    gather_dt = gather_start.datetime
+    year = gather_dt.year
+    month = gather_dt.month
+    day = gather_dt.day
+    hour = gather_dt.hour
+    mins = gather_dt.minute
+    ddir = Path(data_dir, f'{year}', f'{month:02d}', f'{day:02d}')
+    if gather_size.total_seconds() == 86400:
+        # Want to read all files in that day
+        timestamp = f'{year}{month:02d}{day:02d}T*'
+    elif gather_size.total_seconds() == 3600:
+        # Hour gather
+        timestamp = f'{year}{month:02d}{day:02d}T{hour:02d}*'
+    elif gather_size.total_seconds() == 60:
+        # Minute gather
+        timestamp = f"{year}{month:02d}{day:02d}T{hour:02d}{mins:02d}*"
+    else:
+        raise ValueError(f'Gather {gather_size} not day, hour, or minute.')
+    filestem = f"{seed_params}.{timestamp}.mseed"
+    chunk_files = sorted(ddir.glob(filestem))
+    if len(chunk_files) == 0:
+        log.error(f'No files matching {filestem}')
+        return
+    # Write out. Convention here is that file names describe seed codes
+    # and the START time of the file.
+
+    # I will try to support writing as all file types support by obspy.
+    # N.B for SAC files this will default to small-endian files
+    # and will need byte-swapping for use with MacSAC.
+    format_ext = file_format.lower()
+    # Format output timestamp to have zeros below the gather interval
+    # Full time stamp should be 15 characters long.
+    time_out = timestamp.strip('*') + '0'*(15 - len(timestamp.strip('*')))
+    outfile = ddir / f"{seed_params}.{time_out}.{format_ext}"
+    # Write to a .part file first, as outfile may be one of the chunks
+    partfile = outfile.with_name(f'{outfile.name}.part')
+    if merge:
         # Merge traces.
         # Obspy cannot write out masked arrays (i.e., if there are gaps)
         # So to write out a gathered file we need to fill them.
         # Here I elected to zero-fill.
-        # Gaps will also be logged and written out.
-        gaps = gathered_st.get_gaps()
-        if len(gaps) > 0:
-            log.warning('Gaps found - write out')
-            gaplog = f'gaps_in_{timestamp.strip("*")}_data.log'
-            with open(f'{data_dir}/{gaplog}', 'w') as w:
-                for gap in gaps:
-                    line = ','.join([str(g) for g in gap])
-                    w.writelines(f'{line}\n')
-
-        gathered_st.merge(method=0, fill_value=0)
-
-        log.info(f'Merged files: {gather_start}, gather size {gather_size}')
-        # Now clean up the chunked_files and write out our shiny new one!
-        for f in glob.glob(f'{ddir}/filestem'):
-            path_f = Path(f)
-            path_f.unlink(missing_ok=True)
-        # Write out. Convention here is that file names describe seed codes
-        # and the START time of the file.
-
-        # I will try to support writing as all file types support by obspy.
-        # N.B for SAC files this will default to small-endian files
-        # and will need byte-swapping for use with MacSAC.
-        format_ext = file_format.lower()
-        # Format output timestamp to have zeros below the gather interval
-        # Full time stamp should be 15 characters long.
-        time_out = timestamp.strip('*') + '0'*(15 - len(timestamp.strip('*')))
-        outfile = ddir / f"{seed_params}.{time_out}.{format_ext}"
-        gathered_st.write(outfile, format=file_format)
+        gathered_tr, gaps = merge_chunk_files(chunk_files)
+        obspy.Stream([gathered_tr]).write(partfile, format=file_format)
+    else:
+        gaps = concatenate_chunk_files(chunk_files, partfile)
+    # Gaps are logged and written out.
+    if len(gaps) > 0:
+        log.warning('Gaps found - write out')
+        gaplog = f'gaps_in_{timestamp.strip("*")}_data.log'
+        with open(f'{data_dir}/{gaplog}', 'w', newline='') as w:
+            csv.writer(w, lineterminator='\n').writerows(gaps)
+
+    log.info('Merged files: %s, gather size %s', gather_start, gather_size)
+    # Now clean up the chunked_files and move our shiny new one into place!
+    if cleanup:
+        for chunk_file in chunk_files:
+            chunk_file.unlink(missing_ok=True)
+        # The chunks are gone, so marks for chunks that were empty are no
+        # use (the whole gather would be requested again anyway)
+        for mark in ddir.glob(filestem + EMPTY_SUFFIX):
+            mark.unlink(missing_ok=True)
+    partfile.replace(outfile)
+
+
+def concatenate_chunk_files(chunk_files, outfile):
+    '''
+    Concatenates the miniSEED records of chunked files of data for a
+    single channel into outfile, without decoding them.
+
+    Chunks are requested with a buffer either side, so consecutive chunks
+    overlap. Records at the start of each chunk that are entirely covered
+    by the previous chunk are skipped, so at most one partly overlapping
+    record is kept at each join. Records within each chunk must be in
+    time order, and have a fixed record length.
+
+    Parameters:
+    ----------
+    chunk_files : list
+        miniSEED files to concatenate, in time order
+    outfile : str or pathlib.Path
+        File to write out to
+
+    Returns:
+    ----------
+    gaps : list
+        Gaps between chunks in the same form as obspy.Stream.get_gaps
+        (see merge_chunk_files)
+    '''
+    gaps = []
+    prev_end = None
+    with open(outfile, 'wb') as out:
+        for chunk in chunk_files:
+            data = Path(chunk).read_bytes()
+            if len(data) == 0:
+                continue
+            with io.BytesIO(data) as f:
+                info = get_record_information(f)
+                offset = 0
+                if prev_end is not None:
+                    # Skip records already covered by the previous chunk
+                    while (offset < len(data)
+                           and info['endtime'] <= prev_end):
+                        offset += info['record_length']
+                        if offset < len(data):
+                            info = get_record_information(f, offset=offset)
+                    if offset == len(data):
+                        continue
+                    delta = 1 / info['samp_rate']
+                    if info['starttime'] - prev_end > 1.5 * delta:
+                        n_missing = int(round((info['starttime'] - prev_end)
+                                              / delta)) - 1
+                        gaps.append([info['network'], info['station'],
+                                     info['location'], info['channel'],
+                                     prev_end, info['starttime'],
+                                     n_missing * delta, n_missing])
+                last = get_record_information(
+                    f, offset=len(data) - info['record_length'])
+            out.write(memoryview(data)[offset:])
+            prev_end = last['endtime']
+    return gaps
+
+
+def merge_chunk_files(chunk_files, low_level=True):
+    '''
+    Merges chunked files of data for a single channel into one trace.
+
+    The headers of all chunks are read first to work out the timespan of
+    the merged trace, so that we can allocate its data array once. Then
+    each chunk is read in turn and copied into place. This means we only
+    hold one chunk in memory at a time (on top of the merged data),
+    rather than reading all chunks and then merging them with obspy.
+    Any gaps between chunks are zero-filled.
+
+    Parameters:
+    ----------
+    chunk_files : list
+        miniSEED files to merge. Must all contain data for the same channel,
+        with the same sampling rate.
+    low_level : bool
+        If True (default) read chunks with obspy's miniSEED reader
+        (a thin wrapper around libmseed) directly. This skips the
+        globbing and file format detection done by obspy.read, which
+        is a large part of the cost of reading small files.
+        If False use obspy.read.
+
+    Returns:
+    ----------
+    merged : obspy.Trace
+        Trace spanning all data in chunk_files
+    gaps : list
+        Gaps in the merged data in the same form as
+        obspy.Stream.get_gaps (i.e., [network, station, location, channel,
+        gap start, gap end, gap duration, number of missing samples])
+    '''
+    if low_level:
+        read = _read_mseed
+        spans = [_record_span(chunk) for chunk in chunk_files]
+    else:
+        # Give the format so obspy doesn't have to detect it for each file
+        read = functools.partial(obspy.read, format='MSEED')
+        spans = [(tr.stats.starttime, tr.stats.endtime,
+                  tr.stats.sampling_rate)
+                 for chunk in chunk_files
+                 for tr in read(chunk, headonly=True)]
+    sampling_rate = spans[0][2]
+    if any(span[2] != sampling_rate for span in spans):
+        raise ValueError('Chunks have different sampling rates')
+    merge_start = min(span[0] for span in spans)
+    merge_end = max(span[1] for span in spans)
+    npts = int(round((merge_end - merge_start) * sampling_rate)) + 1
+
+    data = None
+    has_data = np.zeros(npts, dtype=bool)
+    for chunk in chunk_files:
+        for tr in read(chunk):
+            if data is None:
+                data = np.zeros(npts, dtype=tr.data.dtype)
+                stats = tr.stats
+            offset = int(round((tr.stats.starttime - merge_start)
+                               * sampling_rate))
+            if offset < 0 or offset + tr.stats.npts > npts:
+                raise ValueError(f'Records in {chunk} are not in time order')
+            data[offset:offset + tr.stats.npts] = tr.data
+            has_data[offset:offset + tr.stats.npts] = True
+
+    merged = obspy.Trace(data=data,
+                         header={'network': stats.network,
+                                 'station': stats.station,
+                                 'location': stats.location,
+                                 'channel': stats.channel,
+                                 'sampling_rate': sampling_rate,
+                                 'starttime': merge_start})
+    # Find the first missing sample and the first sample after each gap
+    edges = np.flatnonzero(np.diff(np.concatenate(([1], has_data, [1]))
+                                   .astype(np.int8)))
+    gaps = []
+    for gap_start, gap_end in zip(edges[::2], edges[1::2]):
+        start = merge_start + (gap_start - 1) * stats.delta
+        end = merge_start + gap_end * stats.delta
+        n_missing = int(gap_end - gap_start)
+        gaps.append([stats.network, stats.station, stats.location,
+                     stats.channel, start, end, n_missing * stats.delta,
+                     n_missing])
+    return merged, gaps
+
+
+def _record_span(chunk):
+    '''
+    Returns the (starttime, endtime, sampling_rate) of a miniSEED file,
+    from the headers of its first and last records. This is much cheaper
+    than reading the headers of every record, but assumes the records
+    are in time order (as they are in files from the sensors).
+    '''
+    first = get_record_information(chunk)
+    last_offset = first['filesize'] - first['record_length']
+    if last_offset % first['record_length'] != 0:
+        # Variable record lengths, so we can't find the last record
+        stats = _read_mseed(chunk, headonly=True)
+        return (min(tr.stats.starttime for tr in stats),
+                max(tr.stats.endtime for tr in stats),
+                first['samp_rate'])
+    last = get_record_information(chunk, offset=last_offset)
+    return first['starttime'], last['endtime'], first['samp_rate']
@@ -1,16 +1,15 @@
 # Author: J Asplet, U of Oxford, 20/11/2023
 
 # Python script to remotely query data from NYMAR array stations
-# We are using Wget as implemented in the requests library
+# Requests are made asynchronously (aiohttp) with data_pipeline.get_data
 # This script is designed to be run as a cron job to send daily requests to
 # remotely installed Certimus/Minimus to get data
-# Data is requested in hourly chunks and then recombined into
+# Data is requested in 6 hour chunks and then recombined into
 # a day length miniSEED file
 #
 # Some editing of this script could make it request minute chunks
 # (for a whole day) or make hourly / minutely requests for data
 
-import asyncio
 import datetime
 import json
 import logging
@@ -19,7 +18,7 @@ import timeit
 
 from obspy import UTCDateTime
 
-from data_pipeline import get_data
+from data_pipeline import get_data, run
 
 log = logging.getLogger(__name__)
 logdir = Path('/home/joseph/logs')
@@ -30,7 +29,8 @@ else:
     logdir = Path.cwd()
     print('Logs written to cwd')
 
-if __name__ == '__main__':
+
+def main():
     today = datetime.datetime.today()
     script_start = timeit.default_timer()
     logging.basicConfig(filename=f'{logdir}/nymar_remote_download_' +
@@ -72,9 +72,9 @@ if __name__ == '__main__':
     # ---------- End of variables to set ----------
 
     # call get_data
-    asyncio.run(get_data(network, station_list, location, channels,
-                start, end, station_ips=ips_dict,
-                data_dir=data_dir))
+    run(get_data(network, station_list, location, channels,
+                 start, end, station_ips=ips_dict,
+                 data_dir=data_dir))
 
     script_end = timeit.default_timer()
     runtime = script_end - script_start
@@ -82,3 +82,7 @@ if __name__ == '__main__':
     log.info(f'Runtime is {runtime:4.2f} seconds,' +
              f'or {runtime/60:4.2f} minutes,' +
              f' or {runtime/3600:4.2f} hours')
+
+
+if __name__ == '__main__':
+    main()
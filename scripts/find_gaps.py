@@ -6,55 +6,65 @@
 
 from obspy import UTCDateTime
 import itertools
-import pickle
 from pathlib import Path
 from datetime import timedelta
-from data_pipeline import iterate_chunks
-
-# Seedlink Parameters
-network = ["OX"]
-station_list = ['NYM1', 'NYM2', 'NYM3', 'NYM4',
-                'NYM5', 'NYM6', 'NYM7', 'NYM8']
-channels = ["HHZ",  "HHN", "HHE"]
-location = ["00"]
-
-expected_file_params = [p for p in itertools.product(network, station_list,
-                        location, channels)]
-
-
-start = UTCDateTime(2024, 7, 1)
-end = UTCDateTime(2024, 10, 31)
-
-dpath = Path('/home/eart0593/NYMAR/raw_data')
-print(f'Assuming data is in: {dpath}')
-
-outfile = 'July_Oct_missing_files.pkl'
-
-data_gaps = []
-
-chunksize = timedelta(days=1)
-
-# Iterate over days
-for h in iterate_chunks(start, end, chunksize):
-    year = h.year
-    month = h.month
-    day = h.day
-    hour = h.hour
-    ddir = Path(f'{dpath}/{year}/{month:02d}/{day:02d}')
-    timestamp = f'{year}{month:02d}{day:02d}T{hour:02d}0000'
-
-    for params in expected_file_params:
-        seedparams = f'{params[0]}.{params[1]}.{params[2]}.{params[3]}'
-        fname = f'{seedparams}.{timestamp}.mseed'
-        f = ddir / fname
-        if f.is_file():
-            # could add check that miniseed file is as we expect
-            continue
-        else:
-            print(f'{f} is missing')
-            gap_params = (params[0], params[1], params[2],
-                          params[3], h, h + chunksize)
-            data_gaps.append(gap_params)
-
-with open(f'{dpath}/{outfile}', 'wb') as f:
-    pickle.dump(data_gaps, f)
+import numpy as np
+from data_pipeline import list_files, save_request_params
+
+
+def main():
+    # Seedlink Parameters
+    network = ["OX"]
+    station_list = ['NYM1', 'NYM2', 'NYM3', 'NYM4',
+                    'NYM5', 'NYM6', 'NYM7', 'NYM8']
+    channels = ["HHZ",  "HHN", "HHE"]
+    location = ["00"]
+
+    expected_file_params = [p for p in itertools.product(network,
+                                                         station_list,
+                                                         location, channels)]
+
+    start = UTCDateTime(2024, 7, 1)
+    end = UTCDateTime(2024, 10, 31)
+
+    dpath = Path('/home/eart0593/NYMAR/raw_data')
+    print(f'Assuming data is in: {dpath}')
+
+    outfile = 'July_Oct_missing_files.npz'
+
+    data_gaps = []
+
+    chunksize = timedelta(days=1)
+
+    # Build all chunk timestamps at once rather than per chunk
+    step = np.timedelta64(int(chunksize.total_seconds()), 's')
+    times = np.arange(np.datetime64(start.datetime),
+                      np.datetime64(end.datetime), step)
+    # 'YYYY-MM-DDTHH' strings
+    dates = np.datetime_as_string(times, unit='h')
+
+    # Iterate over days
+    for t, d in zip(times, dates):
+        ddir = Path(f'{dpath}/{d[:4]}/{d[5:7]}/{d[8:10]}')
+        timestamp = f'{d[:4]}{d[5:7]}{d[8:10]}T{d[11:13]}0000'
+        # List the day directory once rather than checking each file
+        existing_files = list_files(ddir)
+
+        for params in expected_file_params:
+            seedparams = f'{params[0]}.{params[1]}.{params[2]}.{params[3]}'
+            fname = f'{seedparams}.{timestamp}.mseed'
+            if fname in existing_files:
+                # could add check that miniseed file is as we expect
+                continue
+            else:
+                print(f'{ddir / fname} is missing')
+                h = UTCDateTime(str(t))
+                gap_params = (params[0], params[1], params[2],
+                              params[3], h, h + chunksize)
+                data_gaps.append(gap_params)
+
+    save_request_params(dpath / outfile, data_gaps)
+
+
+if __name__ == '__main__':
+    main()
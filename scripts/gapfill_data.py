@@ -1,7 +1,7 @@
 # Author: J Asplet, U of Oxford, 20/11/2023
 
 # Python script to remotely query data from NYMAR array stations
-# We are using Wget as implemented in the requests library
+# Requests are made asynchronously using aiohttp
 # This script is designed to download data for specific channel
 # or network codes. For a bulk download from all insturments
 # in a network or array, use download_data.py
@@ -14,7 +14,7 @@
 # for intruments deployed for the North York Moors Array (NYMAR)
 # and is read in from a json file.
 
-# Data is requested in hourly chunks and then recombined
+# Data is requested in 6 hour chunks and then recombined
 # into a day length miniSEED file
 
 # Some editing of this script could make it request minute chunks
@@ -25,9 +25,9 @@ import timeit
 import datetime
 import json
 import logging
-import pickle
 
-from data_pipeline import chunked_data_query
+from data_pipeline import (as_request_spec, get_data_from_params,
+                           load_request_params, run)
 
 log = logging.getLogger(__name__)
 logdir = Path('/home/joseph/logs')
@@ -38,7 +38,8 @@ else:
     logdir = Path.cwd()
     print(f'Logs written to cwd {logdir}')
 
-if __name__ == '__main__':
+
+def main():
     script_start = timeit.default_timer()
     logging.basicConfig(filename=f'{logdir}/nymar_backfill.log',
                         level=logging.INFO)
@@ -59,9 +60,8 @@ if __name__ == '__main__':
     # Set up request parameters here. This is an example only. You may want
     # To use this script as an exmample to build your own code which finds
     # gaps that need filling and then sends the requests.
-    gapfile = '/Users/eart0593/Projects/Agile/NYMAR/July_Oct_missing_files.pkl'
-    with open(gapfile, 'rb') as f:
-        request_params = pickle.load(f)
+    gapfile = '/Users/eart0593/Projects/Agile/NYMAR/July_Oct_missing_files.npz'
+    request_params = load_request_params(gapfile)
 
     # request_params = [('OX','NYM2','00','HHN',
     #                   UTCDateTime(2024, 10, 1, 0, 0, 0),
@@ -77,29 +77,23 @@ if __name__ == '__main__':
     #                   UTCDateTime(2024, 10,2, 0, 0, 0))]
     # ----------- End of variables to set ----------
 
-    for params in request_params:
-        # params should be form (net, stat, loc, channel, start, end)
-        if params[1] in ['NYM1', 'NYM4']:
-            continue
-
-        log.info(f'Request data for {params}')
-        station_ip = ips_dict[params[1]]
-
-        chunked_data_query(station_ip, network=params[0], station=params[1],
-                           location=params[2], channel=params[3],
-                           starttime=params[4], endtime=params[5],
-                           data_dir=data_dir,
-                           chunksize=datetime.timedelta(hours=1),
-                           buffer=datetime.timedelta(seconds=120))
-        # gather_chunks(network=params[0], station=params[1],
-        #               location=params[2], channel=params[3],
-        #               starttime=params[4], endtime=params[5],
-        #               data_dir=data_dir,
-        #               gather_size=datetime.timedelta(days=1)
-        #               )
+    # params should be form (net, stat, loc, channel, start, end)
+    request_params = [as_request_spec(params) for params in request_params]
+    request_params = [params for params in request_params
+                      if params.station not in ['NYM1', 'NYM4']]
+    log.info(f'Request data for {len(request_params)} gaps')
+
+    run(get_data_from_params(request_params, ips_dict,
+                             data_dir=data_dir,
+                             chunksize=datetime.timedelta(hours=6),
+                             buffer=datetime.timedelta(seconds=120)))
 
     script_end = timeit.default_timer()
     runtime = script_end - script_start
 
     log.info(f'Runtime is {runtime:4.2f} seconds, ' +
              f'or {runtime/60:4.2f} minutes, or {runtime/3600:4.2f} hours')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,7 +1,7 @@
 # Author: J Asplet, U of Oxford, 25/11/2024
 
 # Python script to remotely query VOTLAGE data from NYMAR array stations
-# We are using Wget as implemented in the requests library
+# Requests are made asynchronously (aiohttp) with data_pipeline.get_data
 # This script is designed to download all available data 
 # From an installed Certimus/Minimus for a given period of time.
 
@@ -13,7 +13,6 @@
 # Data is requested in whole day as Voltage data is/should have a much lower
 # sample rate (5 Hz for NYMAR).
 
-import asyncio
 import datetime
 import json
 import logging
@@ -22,7 +21,7 @@ import timeit
 
 from obspy import UTCDateTime
 
-from data_pipeline import get_data
+from data_pipeline import get_data, run
 
 log = logging.getLogger(__name__)
 logdir = Path('/home/joseph/logs')
@@ -33,7 +32,8 @@ else:
     logdir = Path.cwd()
     print(f'Logs written to cwd - {logdir}')
 
-if __name__ == '__main__':
+
+def main():
     script_start = timeit.default_timer()
     logging.basicConfig(filename=f'{logdir}/nymar_backfill.log',
                         level=logging.INFO)
@@ -75,9 +75,9 @@ if __name__ == '__main__':
     # ========== End of variables to set ==========
 
     # call get_data
-    asyncio.run(get_data(network, station_list, location, channels,
-                start, end, station_ips=ips_dict,
-                data_dir=data_dir))
+    run(get_data(network, station_list, location, channels,
+                 start, end, station_ips=ips_dict,
+                 data_dir=data_dir))
 
     script_end = timeit.default_timer()
     runtime = script_end - script_start
@@ -85,3 +85,7 @@ if __name__ == '__main__':
     log.info(f'Runtime is {runtime:4.2f} seconds,' +
              f'or {runtime/60:4.2f} minutes,' +
              f' or {runtime/3600:4.2f} hours')
+
+
+if __name__ == '__main__':
+    main()
@@ -25,6 +25,11 @@ setup(
         "aiohttp==3.10.10"
     ],
 
+    # Optional faster event loop for the async functions (see run)
+    extras_require={
+        "uvloop": ["uvloop>=0.17"]
+    },
+
     # Classifiers for metadata, useful for PyPI (optional, but recommended)
     classifiers=[
         "Programming Language :: Python :: 3",
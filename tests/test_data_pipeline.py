@@ -1,8 +1,16 @@
 import unittest
 from unittest.mock import patch, MagicMock
 from pathlib import Path
+import asyncio
+import aiohttp
 import requests
 import datetime
+import pickle
+import tempfile
+import threading
+import time
+import numpy as np
+import obspy
 import pytest
 from obspy import UTCDateTime
 import data_pipeline  # Assuming this is saved as data_pipeline.py
@@ -20,6 +28,7 @@ class TestDataPipeline(unittest.TestCase):
         self.starttime = UTCDateTime("2024-10-01T00:00:00")
         self.endtime = UTCDateTime("2024-10-01T02:00:00")
         self.ip_dict = {"TEST": self.sensor_ip}
+        self.chunksize = datetime.timedelta(hours=1)
 
     def test_form_request(self):
         """Tests form_request function"""
@@ -46,6 +55,43 @@ class TestDataPipeline(unittest.TestCase):
                                        self.endtime,
                                        self.starttime)
 
+    @patch("data_pipeline._STAMP_BLOCKSIZE", 3)
+    def test_iterate_chunk_stamps(self):
+        """Test _iterate_chunk_stamps matches iterate_chunks."""
+        end = self.starttime + 7.5 * 3600
+        expected = [(chunk.ns, chunk.strftime('%Y%m%dT%H%M%S'))
+                    for chunk in data_pipeline.iterate_chunks(self.starttime,
+                                                              end,
+                                                              self.chunksize)]
+        stamps = list(data_pipeline._iterate_chunk_stamps(self.starttime,
+                                                          end,
+                                                          self.chunksize))
+        self.assertEqual(len(stamps), 8)
+        self.assertEqual(stamps, expected)
+
+    def test_save_load_request_params(self):
+        """Test request parameters can be saved and read back."""
+        request_params = [(self.network, self.station, self.location,
+                           self.channel, self.starttime, self.endtime),
+                          data_pipeline.RequestSpec(self.network, "TEST2",
+                                                    "10", "HHZ",
+                                                    self.starttime + 0.01,
+                                                    self.endtime)]
+        expected = [data_pipeline.as_request_spec(params)
+                    for params in request_params]
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = Path(tmpdir) / 'gaps.npz'
+            data_pipeline.save_request_params(path, request_params)
+            self.assertEqual(data_pipeline.load_request_params(path),
+                             expected)
+            # Old pickle files can still be read
+            pkl_path = Path(tmpdir) / 'gaps.pkl'
+            with open(pkl_path, 'wb') as f:
+                pickle.dump(request_params, f)
+            with self.assertWarns(DeprecationWarning):
+                loaded = data_pipeline.load_request_params(pkl_path)
+            self.assertEqual(loaded, expected)
+
     def test_make_urls(self):
         request_params = [
                          (self.network,
@@ -79,6 +125,113 @@ class TestDataPipeline(unittest.TestCase):
             assert str(outfiles[0]).startswith(data_dir)
             assert outfiles[0].suffix == ".mseed"
 
+    def test_make_urls_existing_files(self):
+        """Test make_urls skips chunks that have already been downloaded."""
+        request_params = [(self.network, self.station, self.location,
+                           self.channel, self.starttime, self.endtime)]
+        with tempfile.TemporaryDirectory() as data_dir:
+            ddir = Path(data_dir, '2024', '10', '01')
+            ddir.mkdir(parents=True)
+            seed = '.'.join([self.network, self.station,
+                             self.location, self.channel])
+            (ddir / f'{seed}.20241001T000000.mseed').touch()
+            urls, outfiles = data_pipeline.make_urls(self.ip_dict,
+                                                     request_params,
+                                                     data_dir,
+                                                     self.chunksize)
+            self.assertEqual(len(urls), 1)
+            self.assertEqual(outfiles[0].name,
+                             f'{seed}.20241001T010000.mseed')
+            self.assertEqual(data_pipeline.list_files(ddir),
+                             {f'{seed}.20241001T000000.mseed'})
+            # Nothing to request, so no directories should be made
+            (ddir / f'{seed}.20241001T010000.mseed').touch()
+            with patch.object(Path, 'mkdir') as mock_mkdir:
+                urls, _ = data_pipeline.make_urls(self.ip_dict,
+                                                  request_params,
+                                                  data_dir,
+                                                  self.chunksize)
+            self.assertEqual(urls, [])
+            mock_mkdir.assert_not_called()
+        self.assertEqual(data_pipeline.list_files(ddir), set())
+
+    @patch("pathlib.Path.mkdir")
+    def test_make_urls_overlapping_params(self, mock_mkdir):
+        """Test make_urls only requests each chunk once."""
+        request_params = [(self.network, self.station, self.location,
+                           self.channel, self.starttime, self.endtime),
+                          (self.network, self.station, self.location,
+                           self.channel, self.starttime + 3600,
+                           self.endtime + 3600)]
+        urls, outfiles = data_pipeline.make_urls(self.ip_dict,
+                                                 request_params,
+                                                 "test_data",
+                                                 self.chunksize)
+        self.assertEqual(len(urls), 3)
+        self.assertEqual(len(set(outfiles)), 3)
+
+    @patch("pathlib.Path.mkdir")
+    def test_make_urls_mkdir_once(self, mock_mkdir):
+        """Test make_urls only makes each day directory once."""
+        request_params = [(self.network, self.station, self.location,
+                           channel, self.starttime, self.endtime)
+                          for channel in ["BHZ", "BHN", "BHE"]]
+        data_pipeline.make_urls(self.ip_dict, request_params, "test_data",
+                                self.chunksize)
+        mock_mkdir.assert_called_once()
+        # Directories are only remembered within a call, in case they
+        # are removed in between
+        data_pipeline.make_urls(self.ip_dict, request_params, "test_data",
+                                self.chunksize)
+        self.assertEqual(mock_mkdir.call_count, 2)
+
+    def test_make_urls_empty_chunks(self):
+        """Test make_urls skips chunks recently marked as empty."""
+        request_params = [(self.network, self.station, self.location,
+                           self.channel, self.starttime, self.endtime)]
+        with tempfile.TemporaryDirectory() as data_dir:
+            ddir = Path(data_dir, '2024', '10', '01')
+            ddir.mkdir(parents=True)
+            seed = '.'.join([self.network, self.station,
+                             self.location, self.channel])
+            data_pipeline._mark_empty(ddir / f'{seed}.20241001T000000.mseed')
+            urls, outfiles = data_pipeline.make_urls(self.ip_dict,
+                                                     request_params,
+                                                     data_dir,
+                                                     self.chunksize)
+            self.assertEqual([f.name for f in outfiles],
+                             [f'{seed}.20241001T010000.mseed'])
+            # Empty marks expire, so the chunk is requested again
+            urls, outfiles = data_pipeline.make_urls(
+                self.ip_dict, request_params, data_dir, self.chunksize,
+                empty_ttl=datetime.timedelta(0))
+            self.assertEqual(len(urls), 2)
+            # and the expired mark is removed
+            self.assertEqual(data_pipeline.list_files(ddir), set())
+
+    def test_make_urls_recent_empty_chunks(self):
+        """Test make_urls ignores empty marks made soon after a chunk."""
+        start = UTCDateTime() - 3600
+        request_params = [(self.network, self.station, self.location,
+                           self.channel, start, start + 3600)]
+        with tempfile.TemporaryDirectory() as data_dir:
+            _, outfiles = data_pipeline.make_urls(self.ip_dict,
+                                                  request_params,
+                                                  data_dir,
+                                                  self.chunksize)
+            # The sensor may not have had the data when it was marked
+            data_pipeline._mark_empty(outfiles[0])
+            urls, _ = data_pipeline.make_urls(self.ip_dict, request_params,
+                                              data_dir, self.chunksize)
+            self.assertEqual(len(urls), 1)
+
+    @patch("data_pipeline.log")
+    def test_mark_empty_missing_dir(self, mock_log):
+        """Test _mark_empty only warns if the directory is missing."""
+        with tempfile.TemporaryDirectory() as data_dir:
+            data_pipeline._mark_empty(Path(data_dir, 'gone', 'x.mseed'))
+        mock_log.warning.assert_called_once()
+
     @patch("data_pipeline.log")
     def test_make_urls_param_errors(self, mock_log):
         # faulty_ip_dict = {"ST01": "192.168.1.1"}
@@ -130,6 +283,62 @@ class TestDataPipeline(unittest.TestCase):
                                         data_dir)
             mock_log.error.assert_called_once()
 
+    def test_request_spec(self):
+        """Test RequestSpec validates start and end times."""
+        spec = data_pipeline.RequestSpec(self.network, self.station,
+                                         self.location, self.channel,
+                                         self.starttime, self.endtime)
+        self.assertEqual(spec.end, self.endtime)
+        with self.assertRaises(ValueError):
+            data_pipeline.RequestSpec(self.network, self.station,
+                                      self.location, self.channel,
+                                      self.endtime, self.starttime)
+        with self.assertRaises(TypeError):
+            data_pipeline.RequestSpec(self.network, self.station,
+                                      self.location, self.channel,
+                                      "not-a-date", self.endtime)
+
+    def test_make_urls_default_chunksize(self):
+        """Test make_urls uses 6 hour chunks by default."""
+        request_params = [(self.network, self.station, self.location,
+                           self.channel, self.starttime,
+                           self.starttime + 86400)]
+        with patch.object(Path, 'mkdir'):
+            urls, outfiles = data_pipeline.make_urls(self.ip_dict,
+                                                     request_params,
+                                                     'test/')
+        self.assertEqual(len(urls), 4)
+        # Chunk length is in the name, so 6 hour chunks can't be
+        # mistaken for hourly chunks starting at the same time
+        self.assertEqual(outfiles[0].name,
+                         'TS.TEST.00.BHZ.20241001T000000.6h.mseed')
+
+    def test_chunk_tag(self):
+        """Test chunk file names describe the chunk size exactly."""
+        self.assertEqual(data_pipeline._chunk_tag(
+            datetime.timedelta(hours=1)), '')
+        self.assertEqual(data_pipeline._chunk_tag(
+            datetime.timedelta(hours=6)), '.6h')
+        self.assertEqual(data_pipeline._chunk_tag(
+            datetime.timedelta(seconds=90)), '.90s')
+        for chunksize in [datetime.timedelta(seconds=0.5),
+                          datetime.timedelta(seconds=1.5),
+                          datetime.timedelta(0),
+                          datetime.timedelta(hours=-1)]:
+            with self.subTest(chunksize=chunksize):
+                with self.assertRaises(ValueError):
+                    data_pipeline.make_urls(self.ip_dict,
+                                            [(self.network, self.station,
+                                              self.location, self.channel,
+                                              self.starttime, self.endtime)],
+                                            'test/', chunksize)
+                with self.assertRaises(ValueError):
+                    data_pipeline.threaded_data_query([], self.ip_dict,
+                                                      'test/', chunksize)
+                with self.assertRaises(ValueError):
+                    data_pipeline.run(data_pipeline.get_data_from_params(
+                        [], self.ip_dict, 'test/', chunksize))
+
     def test_iterate_chunks(self):
         """Test iterate_chunks yields correct time intervals."""
         chunks = list(data_pipeline.iterate_chunks(self.starttime,
@@ -144,49 +353,241 @@ class TestDataPipeline(unittest.TestCase):
 
     # Mock Path.mkdir so no directories are created
     @patch("pathlib.Path.mkdir")
-    @patch("data_pipeline.form_request")
     @patch("data_pipeline.make_request")
     def test_chunked_data_query(self,
                                 mock_make_request,
-                                mock_form_request,
                                 mock_mkdir):
         """Test chunked_data_query forms and makes requests in chunks."""
-        mock_form_request.side_effect = lambda *args, **kwargs: "mock_url"
-
         data_pipeline.chunked_data_query(
             self.sensor_ip, self.network, self.station, self.location,
-            self.channel, self.starttime, self.endtime, data_dir="test_data"
+            self.channel, self.starttime, self.endtime, data_dir="test_data",
+            chunksize=self.chunksize
         )
         # Expect 2 chunks to be processed
-        self.assertEqual(mock_form_request.call_count, 2)
         self.assertEqual(mock_make_request.call_count, 2)
+        urls = sorted(c.args[0] for c in mock_make_request.call_args_list)
+        self.assertTrue(urls[0].startswith(f"http://{self.sensor_ip}/"))
         # Confirm mkdir was called to ensure the directory
         # structure would have been created
         mock_mkdir.assert_called()
 
-    @patch("requests.get")
+    @patch("pathlib.Path.mkdir")
+    @patch("data_pipeline.make_request")
+    def test_threaded_data_query(self, mock_make_request, mock_mkdir):
+        """Test threaded_data_query makes requests to each sensor."""
+        ip_dict = {"TEST": self.sensor_ip, "TEST2": "192.168.1.2:8080"}
+        request_params = [(self.network, station, self.location,
+                           self.channel, self.starttime, self.endtime)
+                          for station in ip_dict]
+        data_pipeline.threaded_data_query(request_params, ip_dict,
+                                          data_dir="test_data",
+                                          chunksize=self.chunksize)
+        self.assertEqual(mock_make_request.call_count, 4)
+        urls = [c.args[0] for c in mock_make_request.call_args_list]
+        self.assertEqual(sum("192.168.1.2" in url for url in urls), 2)
+
+    @patch("pathlib.Path.mkdir")
+    @patch("data_pipeline.make_request")
+    def test_threaded_data_query_sensors_parallel(self, mock_make_request,
+                                                  mock_mkdir):
+        """Test threaded_data_query requests from each sensor at once."""
+        ip_dict = {"TEST": self.sensor_ip, "TEST2": "192.168.1.2:8080"}
+        barrier = threading.Barrier(2, timeout=5)
+        # Each sensor only has one thread, so both waits can only pass
+        # if the two sensors are queried at the same time
+        mock_make_request.side_effect = lambda *args: barrier.wait()
+        # More chunks for each sensor than can be queued at once, so
+        # sensors must also be fed at the same time
+        request_params = [(self.network, station, self.location,
+                           self.channel, self.starttime,
+                           self.starttime + 6 * 3600)
+                          for station in ip_dict]
+        failed = data_pipeline.threaded_data_query(request_params, ip_dict,
+                                                   data_dir="test_data",
+                                                   chunksize=self.chunksize,
+                                                   n_threads=1)
+        self.assertEqual(failed, [])
+        self.assertFalse(barrier.broken)
+        self.assertEqual(mock_make_request.call_count, 12)
+
+    @patch("data_pipeline.iter_urls")
+    @patch("data_pipeline.make_request")
+    def test_threaded_data_query_bounded(self, mock_make_request,
+                                         mock_iter_urls):
+        """Test threaded_data_query only queues a few requests at a time."""
+        n_made = 0
+        queued = []
+
+        def iter_urls(*args):
+            nonlocal n_made
+            for i in range(100):
+                n_made += 1
+                yield f"http://{self.sensor_ip}/data?{i}", f"{i}.mseed"
+
+        def make_request(*args):
+            # Give the feeder time to get ahead of the requests
+            time.sleep(0.01)
+            queued.append(n_made - mock_make_request.call_count)
+
+        mock_iter_urls.side_effect = iter_urls
+        mock_make_request.side_effect = make_request
+        request_params = [(self.network, self.station, self.location,
+                           self.channel, self.starttime, self.endtime)]
+        data_pipeline.threaded_data_query(request_params, self.ip_dict,
+                                          data_dir="test_data", n_threads=1)
+        self.assertEqual(mock_make_request.call_count, 100)
+        # 2 * n_threads queued, plus one the feeder is waiting to submit
+        self.assertLessEqual(max(queued), 3)
+
+    @patch("data_pipeline.log")
+    @patch("pathlib.Path.mkdir")
+    @patch("data_pipeline.make_request")
+    def test_threaded_data_query_failed(self, mock_make_request, mock_mkdir,
+                                        mock_log):
+        """Test threaded_data_query returns the requests that failed."""
+        def make_request(request_url, outfile, session):
+            if outfile.name.endswith('T010000.mseed'):
+                raise requests.exceptions.RetryError('Too many 502s')
+
+        mock_make_request.side_effect = make_request
+        request_params = [(self.network, self.station, self.location,
+                           self.channel, self.starttime, self.endtime)]
+        failed = data_pipeline.threaded_data_query(request_params,
+                                                   self.ip_dict,
+                                                   data_dir="test_data",
+                                                   chunksize=self.chunksize)
+        self.assertEqual(len(failed), 1)
+        request_url, outfile = failed[0]
+        self.assertEqual(outfile.name, 'TS.TEST.00.BHZ.20241001T010000.mseed')
+        mock_log.error.assert_called_once()
+
+    @patch("pathlib.Path.mkdir")
+    @patch("data_pipeline.make_request")
+    def test_threaded_data_query_overlapping_params(self, mock_make_request,
+                                                    mock_mkdir):
+        """Test threaded_data_query only requests each chunk once."""
+        request_params = [(self.network, self.station, self.location,
+                           self.channel, self.starttime, self.endtime),
+                          (self.network, self.station, self.location,
+                           self.channel, self.starttime + 3600,
+                           self.endtime + 3600)]
+        data_pipeline.threaded_data_query(request_params, self.ip_dict,
+                                          data_dir="test_data",
+                                          chunksize=self.chunksize)
+        self.assertEqual(mock_make_request.call_count, 3)
+        outfiles = {c.args[1] for c in mock_make_request.call_args_list}
+        self.assertEqual(len(outfiles), 3)
+
+    @patch("data_pipeline.log")
+    @patch("pathlib.Path.mkdir")
+    @patch("data_pipeline.make_request")
+    def test_threaded_data_query_os_error(self, mock_make_request,
+                                          mock_mkdir, mock_log):
+        """Test threaded_data_query doesn't lose unexpected errors."""
+        mock_make_request.side_effect = OSError('No space left on device')
+        request_params = [(self.network, self.station, self.location,
+                           self.channel, self.starttime, self.endtime)]
+        failed = data_pipeline.threaded_data_query(request_params,
+                                                   self.ip_dict,
+                                                   data_dir="test_data",
+                                                   chunksize=self.chunksize)
+        self.assertEqual(len(failed), 2)
+        self.assertEqual(mock_log.error.call_count, 2)
+
+    def test_run(self):
+        """Test run uses uvloop's event loop only if it is installed."""
+        async def loop_type():
+            return type(asyncio.get_running_loop())
+
+        with patch("data_pipeline.uvloop", None):
+            loop = data_pipeline.run(loop_type())
+        self.assertTrue(issubclass(loop, asyncio.BaseEventLoop))
+        mock_uvloop = MagicMock()
+        mock_uvloop.new_event_loop = asyncio.new_event_loop
+        with patch("data_pipeline.uvloop", mock_uvloop), \
+                patch("asyncio.Runner", wraps=asyncio.Runner) as mock_runner:
+            data_pipeline.run(loop_type())
+            data_pipeline.run(loop_type(), use_uvloop=False)
+        self.assertEqual(mock_runner.call_args_list[0].kwargs,
+                         {'loop_factory': asyncio.new_event_loop})
+        self.assertEqual(mock_runner.call_args_list[1].kwargs,
+                         {'loop_factory': None})
+
+    def test_make_requests_session(self):
+        """Test make_requests_session sizes the connection pool."""
+        session = data_pipeline.make_requests_session(pool_maxsize=32)
+        self.assertEqual(session.get_adapter("http://x")._pool_maxsize, 32)
+        retry = session.get_adapter("http://x").max_retries
+        self.assertIn(502, retry.status_forcelist)
+
+    @patch("pathlib.Path.mkdir")
+    @patch("data_pipeline.make_request")
+    def test_threaded_data_query_many_threads(self, mock_make_request,
+                                              mock_mkdir):
+        """Test threaded_data_query uses a bigger pool for many threads."""
+        request_params = [(self.network, self.station, self.location,
+                           self.channel, self.starttime, self.endtime)]
+        data_pipeline.threaded_data_query(request_params,
+                                          {self.station: self.sensor_ip},
+                                          data_dir="test_data",
+                                          chunksize=self.chunksize,
+                                          n_threads=32)
+        session = mock_make_request.call_args.args[2]
+        self.assertIsNot(session, data_pipeline._session)
+        self.assertEqual(session.get_adapter("http://x")._pool_maxsize, 32)
+
+    @patch("data_pipeline._session.get")
     def test_make_request(self, mock_get):
         """Test make_request handles responses correctly."""
         mock_response = MagicMock()
         mock_response.status_code = 200
-        mock_response.content = b'some_binary_data'
+        mock_response.iter_content.return_value = iter([b'some_binary_data'])
         mock_response.elapsed = datetime.timedelta(seconds=1)
-        mock_get.return_value = mock_response
+        mock_get.return_value.__enter__.return_value = mock_response
 
-        with patch("builtins.open", unittest.mock.mock_open()) as mock_file:
-            data_pipeline.make_request("mock_url", "mock_outfile.mseed")
-            mock_file.assert_called_once_with("mock_outfile.mseed", "wb")
-            mock_file().write.assert_called_once_with(b'some_binary_data')
+        with tempfile.TemporaryDirectory() as tmpdir:
+            outfile = Path(tmpdir) / 'mock_outfile.mseed'
+            data_pipeline.make_request("mock_url", outfile)
+            self.assertEqual(outfile.read_bytes(), b'some_binary_data')
+            self.assertEqual(list(Path(tmpdir).iterdir()), [outfile])
+
+    @patch("data_pipeline._session.get")
+    def test_make_request_interrupted(self, mock_get):
+        """Test make_request leaves no file behind if the stream fails."""
+        def blocks():
+            yield b'some_'
+            raise requests.exceptions.ChunkedEncodingError
+
+        mock_response = mock_get.return_value.__enter__.return_value
+        mock_response.status_code = 200
+        mock_response.iter_content.return_value = blocks()
+        with tempfile.TemporaryDirectory() as tmpdir:
+            outfile = Path(tmpdir) / 'mock_outfile.mseed'
+            with self.assertRaises(requests.exceptions.ChunkedEncodingError):
+                data_pipeline.make_request("mock_url", outfile)
+            self.assertEqual(list(Path(tmpdir).iterdir()), [])
+
+    def test_make_request_session(self):
+        """Test make_request uses the session it is given."""
+        session = MagicMock()
+        mock_response = session.get.return_value.__enter__.return_value
+        mock_response.status_code = 200
+        mock_response.iter_content.return_value = iter([b'some_binary_data'])
+        with tempfile.TemporaryDirectory() as tmpdir:
+            data_pipeline.make_request("mock_url",
+                                       Path(tmpdir) / "mock_outfile.mseed",
+                                       session)
+        session.get.assert_called_once()
 
     @patch("data_pipeline.log")
-    @patch("requests.get")
+    @patch("data_pipeline._session.get")
     def test_make_request_fails(self, mock_get, mock_log):
         """Test make_request fails correctly."""
         mock_response = MagicMock()
         mock_response.status_code = 400
-        mock_response.content = b'some data'  # No data so should raise error
+        mock_response.iter_content.return_value = iter([b'some data'])
         mock_response.elapsed = datetime.timedelta(seconds=1)
-        mock_get.return_value = mock_response
+        mock_get.return_value.__enter__.return_value = mock_response
 
         # Test that an HTTPError is raised as logged
         with self.assertRaises(requests.exceptions.HTTPError):
@@ -195,74 +596,597 @@ class TestDataPipeline(unittest.TestCase):
         # and that make_request continues instead
         mock_response = MagicMock()
         mock_response.status_code = 200
-        mock_response.content = b''
-        mock_get.return_value = mock_response
-        with patch("builtins.open", unittest.mock.mock_open()):
-            data_pipeline.make_request("mock_url", "mock_outfile.mseed")
+        mock_response.iter_content.return_value = iter([])
+        mock_get.return_value.__enter__.return_value = mock_response
+        with tempfile.TemporaryDirectory() as tmpdir:
+            outfile = Path(tmpdir) / "mock_outfile.mseed"
+            data_pipeline.make_request("mock_url", outfile)
             expected_call = "Request is empty! Won’t write a zero byte file."
             mock_log.error.assert_any_call(expected_call)
+            # Chunk is marked as empty so it isn't requested again
+            self.assertEqual([f.name for f in Path(tmpdir).iterdir()],
+                             ["mock_outfile.mseed.empty"])
+
+    @patch("data_pipeline.log")
+    @patch("data_pipeline._session.get")
+    def test_make_request_not_found(self, mock_get, mock_log):
+        """Test make_request marks chunks that aren't found as empty."""
+        mock_response = mock_get.return_value.__enter__.return_value
+        mock_response.status_code = 404
+        with tempfile.TemporaryDirectory() as tmpdir:
+            outfile = Path(tmpdir) / "mock_outfile.mseed"
+            failed = []
+            # Not found isn't a failed request to re-make later
+            data_pipeline._query_chunk("mock_url", outfile, failed=failed)
+            self.assertEqual(failed, [])
+            self.assertEqual([f.name for f in Path(tmpdir).iterdir()],
+                             ["mock_outfile.mseed.empty"])
+        mock_log.error.assert_called_once()
+
+    def write_chunks(self, data_dir, hours):
+        """Writes hour long chunks of synthetic data to data_dir."""
+        ddir = Path(data_dir, '2024', '10', '01')
+        ddir.mkdir(parents=True, exist_ok=True)
+        seed = '.'.join([self.network, self.station,
+                         self.location, self.channel])
+        for hour in hours:
+            chunk_start = self.starttime + datetime.timedelta(hours=hour)
+            tr = obspy.Trace(data=np.arange(3600, dtype=np.int32),
+                             header={'network': self.network,
+                                     'station': self.station,
+                                     'location': self.location,
+                                     'channel': self.channel,
+                                     'sampling_rate': 1,
+                                     'starttime': chunk_start})
+            timestamp = f'20241001T{hour:02d}0000'
+            tr.write(ddir / f'{seed}.{timestamp}.mseed', format='MSEED')
+        return ddir, seed
 
-    @patch("obspy.Stream.get_gaps")
-    @patch("obspy.read")
-    @patch("glob.glob")
     @patch("pathlib.Path.unlink")
     @patch("data_pipeline.log")
-    def test_gather_chunks(self, mock_log, mock_unlink, mock_glob,
-                           mock_obspy_read, mock_get_gaps):
+    def test_gather_chunks(self, mock_log, mock_unlink):
         """Test gather_chunks reads and merges files correctly."""
-        mock_obspy_read.return_value = MagicMock()
-        mock_obspy_read.return_value.merge = MagicMock()
-        mock_obspy_read.return_value.get_gaps = MagicMock()
-        mock_glob.return_value = [Path(f"file_{i}.mseed") for i in range(3)]
-        mock_get_gaps.return_value = []
-
-        data_pipeline.gather_chunks(self.network,
-                                    self.station,
-                                    self.location,
-                                    self.channel,
-                                    self.starttime,
-                                    self.endtime,
-                                    data_dir="test_data",
-                                    gather_size=datetime.timedelta(days=1)
-                                    )
-
-        # Verify that obspy.read was called with the correct file pattern
-        mock_obspy_read.assert_called_once()
-        # Check that merge and cleanup were called
-        mock_obspy_read.return_value.merge.assert_called_once()
-        self.assertEqual(mock_unlink.call_count, 3)
+        with tempfile.TemporaryDirectory() as data_dir:
+            ddir, seed = self.write_chunks(data_dir, [0, 1])
+            data_pipeline.gather_chunks(self.network,
+                                        self.station,
+                                        self.location,
+                                        self.channel,
+                                        self.starttime,
+                                        self.starttime + 86400,
+                                        data_dir=data_dir,
+                                        gather_size=datetime.timedelta(
+                                            days=1)
+                                        )
+            gathered = obspy.read(ddir / f'{seed}.20241001T000000.mseed')
+        # Check chunks were merged into one trace
+        self.assertEqual(len(gathered), 1)
+        self.assertEqual(gathered[0].stats.starttime, self.starttime)
+        self.assertEqual(gathered[0].stats.npts, 7200)
         # Each file should be unlinked
+        self.assertEqual(mock_unlink.call_count, 2)
 
         # Verify that logging was called with expected messages
         mock_log.info.assert_called_once()
         mock_log.warning.assert_not_called()
         mock_log.error.assert_not_called()
 
-    @patch("obspy.read")
-    @patch("pathlib.Path.glob")
-    @patch("pathlib.Path.unlink")
     @patch("data_pipeline.log")
-    def test_gather_chunks_warning(self,
-                                   mock_log,
-                                   mock_unlink,
-                                   mock_glob,
-                                   mock_obspy_read):
+    def test_gather_chunks_warning(self, mock_log):
         """
-        Test gather_chunks reads and merges files correctly.
+        Test gather_chunks logs and zero-fills gaps.
         """
-        mock_obspy_read.return_value = MagicMock()
-        mock_obspy_read.return_value.merge = MagicMock()
-        mock_obspy_read.return_value.get_gaps = MagicMock()
-        mock_obspy_read.return_value.get_gaps.return_value = ['some', 'gaps']
-        mock_glob.return_value = [Path(f"file_{i}.mseed") for i in range(3)]
-        with patch('builtins.open', unittest.mock.mock_open()):
+        with tempfile.TemporaryDirectory() as data_dir:
+            ddir, seed = self.write_chunks(data_dir, [0, 2])
+            data_pipeline._mark_empty(ddir / f'{seed}.20241001T010000.mseed')
             data_pipeline.gather_chunks(
                 self.network, self.station, self.location, self.channel,
-                self.starttime, self.endtime, data_dir="test_data",
+                self.starttime, self.starttime + 86400, data_dir=data_dir,
                 gather_size=datetime.timedelta(days=1)
             )
+            gathered = obspy.read(ddir / f'{seed}.20241001T000000.mseed')
+            gaplog = Path(data_dir, 'gaps_in_20241001T_data.log')
+            gap_lines = gaplog.read_text().splitlines()
+            # Chunk files (and empty marks) should have been cleaned up
+            remaining = sorted(p.name for p in ddir.iterdir())
 
         mock_log.warning.assert_called_once()
+        self.assertEqual(len(gap_lines), 1)
+        self.assertTrue(gap_lines[0].endswith(',3600'))
+        # Gap should be zero-filled
+        self.assertEqual(gathered[0].stats.npts, 3 * 3600)
+        self.assertFalse(gathered[0].data[3600:7200].any())
+        self.assertEqual(remaining, [f'{seed}.20241001T000000.mseed'])
+
+    @patch("data_pipeline.log")
+    def test_gather_chunks_hourly(self, mock_log):
+        """Test gather_chunks makes hour long gathers."""
+        with tempfile.TemporaryDirectory() as data_dir:
+            ddir, seed = self.write_chunks(data_dir, [0, 1])
+            data_pipeline.gather_chunks(
+                self.network, self.station, self.location, self.channel,
+                self.starttime, self.endtime, data_dir=data_dir,
+                gather_size=datetime.timedelta(hours=1)
+            )
+            gathered = sorted(p.name for p in ddir.iterdir())
+        self.assertEqual(gathered, [f'{seed}.20241001T000000.mseed',
+                                    f'{seed}.20241001T010000.mseed'])
+        # One merge per hour
+        self.assertEqual(mock_log.info.call_count, 2)
+        mock_log.error.assert_not_called()
+
+    def test_gather_chunks_no_cleanup(self):
+        """Test gather_chunks keeps chunked files if cleanup is False."""
+        with tempfile.TemporaryDirectory() as data_dir:
+            ddir, seed = self.write_chunks(data_dir, [0, 1])
+            data_pipeline.gather_chunks(
+                self.network, self.station, self.location, self.channel,
+                self.starttime, self.starttime + 86400, data_dir=data_dir,
+                gather_size=datetime.timedelta(days=1), cleanup=False
+            )
+            self.assertTrue((ddir / f'{seed}.20241001T010000.mseed')
+                            .is_file())
+
+    def test_gather_chunks_processes(self):
+        """Test gather_chunks makes hourly gathers in parallel."""
+        with tempfile.TemporaryDirectory() as data_dir:
+            ddir, seed = self.write_chunks(data_dir, [0, 1])
+            data_pipeline.gather_chunks(
+                self.network, self.station, self.location, self.channel,
+                self.starttime, self.endtime, data_dir=data_dir,
+                gather_size=datetime.timedelta(hours=1), cleanup=False,
+                n_processes=2
+            )
+            for hour in [0, 1]:
+                st = obspy.read(ddir / f'{seed}.20241001T0{hour}0000.mseed')
+                self.assertEqual(st[0].stats.npts, 3600)
+
+    def test_merge_chunk_files(self):
+        """Test merge_chunk_files handles overlapping chunks."""
+        full = np.arange(7200, dtype=np.int32)
+        with tempfile.TemporaryDirectory() as data_dir:
+            chunk_files = []
+            # Two chunks which overlap by 5 minutes
+            for i, (s, e) in enumerate([(0, 3900), (3300, 7200)]):
+                tr = obspy.Trace(data=full[s:e].copy(),
+                                 header={'sampling_rate': 1,
+                                         'starttime': self.starttime + s})
+                chunk_files.append(Path(data_dir, f'chunk_{i}.mseed'))
+                tr.write(chunk_files[-1], format='MSEED')
+            for low_level in [True, False]:
+                with self.subTest(low_level=low_level):
+                    merged, gaps = data_pipeline.merge_chunk_files(
+                        chunk_files, low_level=low_level)
+                    self.assertEqual(gaps, [])
+                    self.assertEqual(merged.stats.starttime, self.starttime)
+                    np.testing.assert_array_equal(merged.data, full)
+
+    def test_concatenate_chunk_files(self):
+        """Test concatenate_chunk_files drops overlaps and finds gaps."""
+        full = np.arange(10800, dtype=np.int32)
+        with tempfile.TemporaryDirectory() as data_dir:
+            chunk_files = []
+            # Two chunks which overlap by 5 minutes, then a 10 minute gap
+            for i, (s, e) in enumerate([(0, 3900), (3300, 7200),
+                                        (7800, 10800)]):
+                tr = obspy.Trace(data=full[s:e].copy(),
+                                 header={'sampling_rate': 1,
+                                         'starttime': self.starttime + s})
+                chunk_files.append(Path(data_dir, f'chunk_{i}.mseed'))
+                tr.write(chunk_files[-1], format='MSEED', reclen=512)
+            outfile = Path(data_dir, 'gathered.mseed')
+            gaps = data_pipeline.concatenate_chunk_files(chunk_files,
+                                                         outfile)
+            self.assertEqual(len(gaps), 1)
+            self.assertEqual(gaps[0][5], self.starttime + 7800)
+            self.assertEqual(gaps[0][6:], [600, 600])
+            # Only the last record before each join may overlap
+            st = obspy.read(outfile)
+            self.assertLess(sum(tr.stats.npts for tr in st),
+                            10800 - 600 + 2 * 512)
+            st.merge()
+            merged = st.split()
+            np.testing.assert_array_equal(merged[0].data, full[:7200])
+            np.testing.assert_array_equal(merged[1].data, full[7800:])
+
+    def test_gather_chunks_concatenate(self):
+        """Test gather_chunks can gather chunks without merging."""
+        with tempfile.TemporaryDirectory() as data_dir:
+            ddir, seed = self.write_chunks(data_dir, [0, 1])
+            data_pipeline.gather_chunks(
+                self.network, self.station, self.location, self.channel,
+                self.starttime, self.starttime + 86400, data_dir=data_dir,
+                merge=False
+            )
+            self.assertEqual([f.name for f in ddir.iterdir()],
+                             [f'{seed}.20241001T000000.mseed'])
+            st = obspy.read(ddir / f'{seed}.20241001T000000.mseed')
+            self.assertEqual(len(st.merge()), 1)
+            self.assertEqual(st[0].stats.npts, 7200)
+            with self.assertRaises(ValueError):
+                data_pipeline.gather_chunks(
+                    self.network, self.station, self.location, self.channel,
+                    self.starttime, self.starttime + 86400,
+                    data_dir=data_dir, file_format='SAC', merge=False
+                )
+
+    def test_record_span(self):
+        """Test _record_span matches the span read from every header."""
+        tr = obspy.Trace(data=np.arange(3600, dtype=np.int32),
+                         header={'sampling_rate': 1,
+                                 'starttime': self.starttime})
+        with tempfile.TemporaryDirectory() as data_dir:
+            chunk = Path(data_dir, 'chunk.mseed')
+            tr.write(chunk, format='MSEED', reclen=512)
+            self.assertEqual(data_pipeline._record_span(chunk),
+                             (tr.stats.starttime, tr.stats.endtime, 1.0))
+
+
+def mock_session(chunks, status=200, content_length=True, headers=None):
+    """Makes a mock aiohttp session whose response streams chunks."""
+    async def iter_chunked(size):
+        for chunk in chunks:
+            yield chunk
+
+    mock_resp = MagicMock()
+    mock_resp.status = status
+    if content_length:
+        mock_resp.content_length = sum(len(chunk) for chunk in chunks)
+    else:
+        mock_resp.content_length = None
+    mock_resp.headers = {} if headers is None else headers
+    mock_resp.raise_for_status = MagicMock()
+    mock_resp.content.iter_chunked = iter_chunked
+    mock_resp.content.iter_any = lambda: iter_chunked(None)
+    session = MagicMock()
+    session.get.return_value.__aenter__.return_value = mock_resp
+    return session
+
+
+class TestAsyncDataPipeline(unittest.IsolatedAsyncioTestCase):
+
+    async def test_make_async_request(self):
+        """Test make_async_request writes the response to file."""
+        for content_length in [True, False]:
+            with self.subTest(content_length=content_length):
+                session = mock_session([b'some_', b'binary_data'],
+                                       content_length=content_length)
+                with tempfile.TemporaryDirectory() as tmpdir:
+                    outfile = Path(tmpdir) / 'mock_outfile.mseed'
+                    await data_pipeline.make_async_request(session,
+                                                           "mock_url",
+                                                           outfile)
+                    self.assertEqual(outfile.read_bytes(),
+                                     b'some_binary_data')
+
+    @patch("data_pipeline.MAX_BUFFER_SIZE", 8)
+    async def test_make_async_request_large(self):
+        """Test make_async_request streams large responses to disk."""
+        session = mock_session([b'some_', b'binary_data'])
+        mock_resp = session.get.return_value.__aenter__.return_value
+        mock_resp.content.iter_any = MagicMock()
+        with tempfile.TemporaryDirectory() as tmpdir:
+            outfile = Path(tmpdir) / 'mock_outfile.mseed'
+            await data_pipeline.make_async_request(session,
+                                                   "mock_url",
+                                                   outfile)
+            self.assertEqual(outfile.read_bytes(), b'some_binary_data')
+        mock_resp.content.iter_any.assert_not_called()
+
+    @patch("data_pipeline.WRITE_BATCHSIZE", 8)
+    @patch("data_pipeline.MAX_BUFFER_SIZE", 0)
+    async def test_make_async_request_batched(self):
+        """Test make_async_request writes streamed chunks in batches."""
+        chunks = [b'some_', b'bin', b'ary', b'_da', b'ta']
+        session = mock_session(chunks)
+        with tempfile.TemporaryDirectory() as tmpdir:
+            outfile = Path(tmpdir) / 'mock_outfile.mseed'
+            with patch("asyncio.to_thread",
+                       wraps=asyncio.to_thread) as mock_to_thread:
+                await data_pipeline.make_async_request(session,
+                                                       "mock_url",
+                                                       outfile)
+            self.assertEqual(outfile.read_bytes(), b'some_binary_data')
+        # One full 8 byte batch, then the rest when the file is closed
+        batches = [c.args[1] for c in mock_to_thread.call_args_list
+                   if len(c.args) > 1 and isinstance(c.args[1], list)]
+        self.assertEqual(batches, [chunks[:2], chunks[2:]])
+
+    async def test_make_async_request_resume(self):
+        """Test make_async_request resumes partial downloads."""
+        session = mock_session([b'binary_data'], status=206,
+                               headers={'Content-Range': 'bytes 5-15/16'})
+        with tempfile.TemporaryDirectory() as tmpdir:
+            outfile = Path(tmpdir) / 'mock_outfile.mseed'
+            partfile = Path(tmpdir) / 'mock_outfile.mseed.part'
+            partfile.write_bytes(b'some_')
+            await data_pipeline.make_async_request(session,
+                                                   "mock_url",
+                                                   outfile)
+            self.assertEqual(outfile.read_bytes(), b'some_binary_data')
+            self.assertFalse(partfile.exists())
+        session.get.assert_called_once_with("mock_url",
+                                            headers={
+                                                'Range': 'bytes=5-',
+                                                'Accept-Encoding': 'identity'})
+
+    async def test_make_async_request_restart(self):
+        """Test make_async_request restarts downloads it can't resume."""
+        cases = {
+            # Sensor sends a different range than asked for
+            'wrong_range': mock_session([b'some_binary_data'], status=206,
+                                        headers={'Content-Range':
+                                                 'bytes 0-15/16'}),
+            # Part file is longer than the data the sensor has
+            'unsatisfiable': mock_session([], status=416),
+        }
+        for case, first in cases.items():
+            with self.subTest(case=case):
+                session = mock_session([b'some_binary_data'])
+                second = session.get.return_value
+                session.get.side_effect = [first.get.return_value, second]
+                with tempfile.TemporaryDirectory() as tmpdir:
+                    outfile = Path(tmpdir) / 'mock_outfile.mseed'
+                    partfile = Path(tmpdir) / 'mock_outfile.mseed.part'
+                    partfile.write_bytes(b'stale_data_that_is_too_long')
+                    done = await data_pipeline.make_async_request(
+                        session, "mock_url", outfile)
+                    self.assertTrue(done)
+                    self.assertEqual(outfile.read_bytes(),
+                                     b'some_binary_data')
+                    self.assertFalse(partfile.exists())
+                self.assertEqual(session.get.call_count, 2)
+                # Second request is for the whole file
+                self.assertIsNone(session.get.call_args.kwargs['headers'])
+
+    async def test_make_async_request_compressed(self):
+        """Test make_async_request handles compressed responses."""
+        # Content-Length is the compressed size, so is smaller than the
+        # decompressed data aiohttp streams back.
+        session = mock_session([b'some_', b'binary_data'],
+                               headers={'Content-Encoding': 'gzip'})
+        session.get.return_value.__aenter__.return_value.content_length = 10
+        with tempfile.TemporaryDirectory() as tmpdir:
+            outfile = Path(tmpdir) / 'mock_outfile.mseed'
+            await data_pipeline.make_async_request(session,
+                                                   "mock_url",
+                                                   outfile)
+            self.assertEqual(outfile.read_bytes(), b'some_binary_data')
+
+    @patch("data_pipeline.log")
+    async def test_make_async_request_empty(self, mock_log):
+        """Test make_async_request does not write empty responses."""
+        for content_length in [True, False]:
+            with self.subTest(content_length=content_length):
+                mock_log.reset_mock()
+                session = mock_session([], content_length=content_length)
+                mock_resp = session.get.return_value.__aenter__.return_value
+                mock_resp.content.iter_chunked = MagicMock(
+                    wraps=mock_resp.content.iter_chunked)
+                with tempfile.TemporaryDirectory() as tmpdir:
+                    outfile = Path(tmpdir) / 'mock_outfile.mseed'
+                    await data_pipeline.make_async_request(session,
+                                                           "mock_url",
+                                                           outfile)
+                    self.assertFalse(outfile.exists())
+                    self.assertTrue(data_pipeline._recently_empty(outfile, 0))
+                mock_log.error.assert_called_once()
+                # With Content-Length: 0 the body isn't read at all
+                self.assertEqual(mock_resp.content.iter_chunked.called,
+                                 not content_length)
+
+    async def test_make_session(self):
+        """Test make_session limits connections per sensor."""
+        async with data_pipeline.make_session(n_async_requests=2) as session:
+            self.assertEqual(session.connector.limit_per_host, 2)
+            self.assertEqual(session.connector.limit, 0)
+
+    @patch("asyncio.sleep")
+    @patch("data_pipeline._download")
+    async def test_make_async_request_retry(self, mock_download, mock_sleep):
+        """Test make_async_request retries transient errors only."""
+        def http_error(status, headers=None):
+            return aiohttp.ClientResponseError(MagicMock(), (),
+                                               status=status,
+                                               headers=headers)
+        # Retry on server errors, waiting for Retry-After if given
+        mock_download.side_effect = [http_error(503),
+                                     http_error(429, {'Retry-After': '7'}),
+                                     None]
+        await data_pipeline.make_async_request(MagicMock(), "mock_url",
+                                               "mock_outfile.mseed",
+                                               max_retries=3, backoff=1)
+        self.assertEqual(mock_download.call_count, 3)
+        self.assertEqual(mock_sleep.call_count, 2)
+        self.assertEqual(mock_sleep.call_args_list[1].args[0], 7.0)
+        # Long waits are capped
+        mock_download.reset_mock(side_effect=True)
+        mock_download.side_effect = [http_error(503, {'Retry-After': '600'}),
+                                     None]
+        await data_pipeline.make_async_request(MagicMock(), "mock_url",
+                                               "mock_outfile.mseed",
+                                               max_wait=30)
+        self.assertEqual(mock_sleep.call_args.args[0], 30)
+        # Don't retry client errors. Chunks that aren't found are
+        # marked as empty, and any part file from an earlier attempt
+        # is removed so it isn't resumed from later.
+        mock_download.reset_mock(side_effect=True)
+        mock_download.side_effect = http_error(404)
+        with tempfile.TemporaryDirectory() as tmpdir:
+            outfile = Path(tmpdir) / "mock_outfile.mseed"
+            partfile = Path(tmpdir) / "mock_outfile.mseed.part"
+            partfile.write_bytes(b'some_')
+            await data_pipeline.make_async_request(MagicMock(), "mock_url",
+                                                   outfile)
+            self.assertTrue(data_pipeline._recently_empty(outfile, 0))
+            self.assertFalse(partfile.exists())
+        self.assertEqual(mock_download.call_count, 1)
+        # Give up after max_retries
+        mock_download.reset_mock(side_effect=True)
+        mock_download.side_effect = aiohttp.ClientConnectionError()
+        done = await data_pipeline.make_async_request(MagicMock(), "mock_url",
+                                                      "mock_outfile.mseed",
+                                                      max_retries=2)
+        self.assertEqual(mock_download.call_count, 3)
+        self.assertFalse(done)
+        # Each failed attempt is reported
+        mock_download.reset_mock()
+        on_error = MagicMock()
+        await data_pipeline.make_async_request(MagicMock(), "mock_url",
+                                               "mock_outfile.mseed",
+                                               max_retries=2,
+                                               on_error=on_error)
+        self.assertEqual(on_error.call_count, 3)
+
+    @patch("data_pipeline.make_async_request")
+    @patch("data_pipeline.iter_urls")
+    async def test_get_data(self, mock_iter_urls, mock_make_async_request):
+        """Test get_data makes every request with a fixed worker pool."""
+        urls = [f"http://192.168.1.1/data?{i}" for i in range(10)]
+        outfiles = [f"outfile_{i}.mseed" for i in range(10)]
+        mock_iter_urls.return_value = zip(urls, outfiles)
+        session = MagicMock()
+        await data_pipeline.get_data(["TS"], ["TEST"], ["00"], ["BHZ"],
+                                     [UTCDateTime(2024, 10, 1)],
+                                     [UTCDateTime(2024, 10, 2)],
+                                     {"TEST": "192.168.1.1"},
+                                     n_async_requests=2,
+                                     session=session)
+        self.assertEqual(mock_make_async_request.call_count, 10)
+        called = sorted(c.args[1] for c in
+                        mock_make_async_request.call_args_list)
+        self.assertEqual(called, sorted(urls))
+
+    async def test_gather_requests_bounded(self):
+        """Test _gather_requests only takes a few requests at a time."""
+        n_yielded = 0
+        max_ahead = 0
+
+        threads = set()
+
+        def reqs():
+            nonlocal n_yielded
+            for i in range(100):
+                threads.add(threading.get_ident())
+                n_yielded += 1
+                yield f"mock_url_{i}", f"{i}.mseed"
+
+        n_done = 0
+
+        async def make_async_request(session, request_url, outfile):
+            nonlocal n_done, max_ahead
+            await asyncio.sleep(0)
+            max_ahead = max(max_ahead, n_yielded - n_done)
+            n_done += 1
+
+        with patch("data_pipeline.make_async_request", make_async_request), \
+                patch("data_pipeline.log") as mock_log:
+            n_requests = await data_pipeline._gather_requests(MagicMock(),
+                                                              reqs(), 2)
+        self.assertEqual(n_requests, 100)
+        # At most 2 requests in progress, 4 in the queue and a batch
+        # of 2 waiting
+        self.assertLessEqual(max_ahead, 8)
+        # Requests are made off the event loop's thread
+        self.assertNotIn(threading.get_ident(), threads)
+        # Progress is logged once per PROGRESS_INTERVAL requests
+        mock_log.info.assert_called_once_with('Finished %d requests to %s',
+                                              100, None)
+
+    async def test_adaptive_limit(self):
+        """Test _AdaptiveLimit grows while fast and halves on failure."""
+        limit = data_pipeline._AdaptiveLimit(2, 4)
+        for _ in range(20):
+            await limit.acquire()
+            await limit.release(1.0)
+        self.assertEqual(limit.limit, 4)
+        # Slow requests don't raise the limit
+        limit.limit = 3
+        await limit.acquire()
+        await limit.release(10.0)
+        self.assertEqual(limit.limit, 3)
+        await limit.acquire()
+        limit.drop()
+        await limit.release(None)
+        self.assertEqual(limit.limit, 1.5)
+        await limit.acquire()
+        # Only one request at a time now
+        with self.assertRaises(asyncio.TimeoutError):
+            await asyncio.wait_for(limit.acquire(), timeout=0.01)
+        limit.drop()
+        limit.drop()
+        await limit.release(None)
+        self.assertEqual(limit.limit, 1)
+        self.assertEqual(limit.in_flight, 0)
+
+    async def test_gather_requests_adaptive(self):
+        """Test _gather_requests adapts how many requests it makes."""
+        in_flight = 0
+        max_in_flight = 0
+
+        def reqs():
+            for i in range(40):
+                yield f"mock_url_{i}", f"{i}.mseed"
+
+        async def make_async_request(session, request_url, outfile,
+                                     on_error):
+            nonlocal in_flight, max_in_flight
+            in_flight += 1
+            max_in_flight = max(max_in_flight, in_flight)
+            # Long enough for the queue to fill up between requests
+            await asyncio.sleep(0.01)
+            in_flight -= 1
+            if not ok:
+                on_error()
+            return ok
+
+        # Requests all succeed, so can make up to 4 at a time
+        ok = True
+        with patch("data_pipeline.make_async_request", make_async_request):
+            n_requests = await data_pipeline._gather_requests(MagicMock(),
+                                                              reqs(), 2, 4)
+        self.assertEqual(n_requests, 40)
+        self.assertEqual(max_in_flight, 4)
+        # Requests all fail, so never make more than the initial 2
+        ok = False
+        max_in_flight = 0
+        with patch("data_pipeline.make_async_request", make_async_request):
+            await data_pipeline._gather_requests(MagicMock(), reqs(), 2, 4)
+        self.assertEqual(max_in_flight, 2)
+
+    @patch("data_pipeline.iter_urls")
+    async def test_get_data_per_sensor(self, mock_iter_urls):
+        """Test get_data gives each sensor its own pool of workers."""
+        ip_dict = {"TEST": "192.168.1.1", "TEST2": "192.168.1.2"}
+
+        def iter_urls(ips, params, *args, **kwargs):
+            # params are made lazily
+            self.assertNotIsInstance(params, list)
+            ip = ips[next(iter(params)).station]
+            return ((f"http://{ip}/data?{i}", f"{i}.mseed")
+                    for i in range(10))
+
+        mock_iter_urls.side_effect = iter_urls
+        in_flight = {ip: 0 for ip in ip_dict.values()}
+        max_in_flight = dict(in_flight)
+
+        async def make_async_request(session, request_url, outfile):
+            ip = request_url.split('/')[2]
+            in_flight[ip] += 1
+            max_in_flight[ip] = max(max_in_flight[ip], in_flight[ip])
+            await asyncio.sleep(0)
+            in_flight[ip] -= 1
+
+        with patch("data_pipeline.make_async_request", make_async_request):
+            await data_pipeline.get_data(["TS"], list(ip_dict), ["00"],
+                                         ["BHZ"],
+                                         [UTCDateTime(2024, 10, 1)],
+                                         [UTCDateTime(2024, 10, 2)],
+                                         ip_dict,
+                                         n_async_requests=2,
+                                         session=MagicMock())
+        self.assertEqual(mock_iter_urls.call_count, 2)
+        self.assertEqual(max_in_flight, {ip: 2 for ip in ip_dict.values()})
 
 
 if __name__ == '__main__':